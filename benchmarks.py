@@ -0,0 +1,1297 @@
+#! /usr/bin/env python
+
+###############################################################################
+#                                                                             #
+#       BENCHMARKS.PY (timings of narabot.py against local stand-ins)         #
+#                                                                             #
+#  Each benchmark compares a part of narabot.py with the way it used to be    #
+#  done, without touching the catalog or Commons:                             #
+#                                                                             #
+#      python benchmarks.py                # all of them                      #
+#      python benchmarks.py wikitext       # just the named ones              #
+#                                                                             #
+###############################################################################
+
+from __future__ import print_function
+import BaseHTTPServer
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+import cgi
+import cookielib
+import gzip
+import imp
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+import narabot
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+###############################################################################
+#  transport: a shared keep-alive Transport against a urllib2 opener per item
+#
+
+class CatalogStandin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a catalog-sized page, gzipped if asked, over HTTP/1.1.
+
+    The first request on each connection is held for setup_delay seconds, a
+    stand-in for the TCP and TLS handshakes with a remote host.
+    """
+    daemon_threads = True
+    page = ("<html><body>" + "<p>Scope and content of the item</p>\n" * 1500 +
+            "</body></html>")
+
+    def __init__(self, setup_delay=0.01):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           CatalogHandler)
+        self.setup_delay = setup_delay
+        out = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(self.page)
+        self.gzipped_page = out.getvalue()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://localhost:{0}/".format(self.server_port)
+
+
+class CatalogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # written out in one go, as a real server would, rather than a packet
+    # per header (which keeps kept-alive connections waiting on Nagle)
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        time.sleep(self.server.setup_delay)
+
+    def do_GET(self):
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = self.server.gzipped_page if gzipped else self.server.page
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'JSESSIONID=1; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def fetch_with_openers(url, items, pages):
+    # as Item used to: an opener and cookie jar of its own for every item
+    for n in range(items):
+        opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        for page in range(pages):
+            opener.open(url).read()
+
+
+def fetch_with_transport(url, items, pages):
+    transport = narabot.Transport()
+    for n in range(items):
+        jar = cookielib.CookieJar()
+        for page in range(pages):
+            transport.open(url, jar=jar).read()
+    transport.close()
+
+
+def in_threads(function, threads, *args):
+    workers = [threading.Thread(target=function, args=args)
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def bench_transport(items=48, pages=4, threads=4):
+    server = CatalogStandin()
+    requests = items * pages
+    print("{0} items of {1} pages each, {2:.0f} ms connection setup"
+          .format(items, pages, server.setup_delay * 1000))
+    for name, fetch in [("urllib2 opener per item", fetch_with_openers),
+                        ("shared Transport", fetch_with_transport)]:
+        server.bytes_sent = 0
+        elapsed, result = timed(fetch, server.url, items, pages)
+        print("  {0:<24} {1:7.1f} requests/s  {2:8.1f} kB received"
+              .format(name, requests / elapsed, server.bytes_sent / 1024.0))
+        server.bytes_sent = 0
+        elapsed, result = timed(in_threads, fetch, threads, server.url,
+                                items // threads, pages)
+        print("  {0:<24} {1:7.1f} requests/s  ({2} threads)"
+              .format("", requests / elapsed, threads))
+    server.shutdown()
+
+
+###############################################################################
+#  wikitext: rendering every page of an item, as the bot does, against the
+#  way File.wiki_filename and File.wikitext used to work it out
+#
+
+def legacy_wiki_filename(file):
+    if len(file.item.files) == 1:
+        suffix = " - NARA - {0}{1}".format(file.item.arcid,
+                                           file.canonical_extension)
+    else:
+        suffix = ", p. {0} of {1} - NARA - {2}{3}" \
+                 .format(file.index + 1,
+                         len(file.item.files),
+                         file.item.arcid,
+                         file.canonical_extension)
+    title = file.item.description
+    while len(title + suffix) > 120:
+        title = re.sub('\s+\S+$', '', title)
+    if title == "":
+        title = file.item.description[:120 - len(suffix)]
+    title = re.sub(r'#|<|>|\[|\]|\||\{|\}|:|/', '-', title)
+    title = re.sub('\s+', ' ', title)
+    return title + suffix
+
+def legacy_wikitext(file):
+    escape = narabot.wikitext_escape
+    item = file.item
+    all_pages = [(p+1, legacy_wiki_filename(f))
+                 for p, f in enumerate(item.files)]
+    m = {}
+    m['title'] = escape(item.description)
+    m['scope_and_content'] = escape(item.scope_and_content or "")
+    m['general_notes'] = escape(item.general_notes or "")
+    m['arc'] = item.arcid
+    m['local_identifier'] = escape(item.local_id or "")
+    m['creator'] = "<br/>\n".join(map(escape, item.creators or []))
+    m['author'] = "<br/>\n".join(
+        "{{{{NARA-Author|{0}|{1}}}}}".format(escape(author.name), author.id)
+        for author in item.authors or [])
+    places = []
+    for place in item.places or []:
+        if place.latitude and place.longitude:
+            places.append("{{{{NARA-Place|{0}|{1}|{2}|{3}}}}}"
+                          .format(escape(place.name), place.id,
+                                  float(place.latitude),
+                                  float(place.longitude)))
+        else:
+            places.append("{{{{NARA-Place|{0}|{1}}}}}"
+                          .format(escape(place.name), place.id))
+    m['place'] = "<br/>\n".join(places)
+    m['location'] = "<br/>\n".join(map(escape, item.contacts or ""))
+    m['date'] = item.dates or ""
+    m['record_group_arc'], m['record_group'] = item.record_group or ("", "")
+    m['series_arc'], m['series'] = item.series or ("", "")
+    m['file_unit_arc'], m['file_unit'] = item.file_unit or ("", "")
+    m['variant_control_numbers'] = \
+        "\n*".join(map(escape, item.variant_control_numbers or []))
+    tiff = isinstance(file, narabot.TIFFFile)
+    m['tiff'] = "yes" if tiff else ""
+    m['other_versions'] = ""
+    if tiff:
+        m['other_versions'] = \
+            "<gallery>\nFile:{0}|This page as TIFF\nFile:{1}|This page as JPG\n</gallery>".format(
+                legacy_wiki_filename(file),
+                legacy_wiki_filename(file)[:-4] + ".jpg")
+    m['other_pages'] = ""
+    if len(all_pages) > 1:
+        tiflinks = ""
+        jpglinks = ""
+        for (pagenumber, filename) in all_pages:
+            if filename.endswith(".tif"):
+                tiflinks += 'File:{0}|page&#32;{1} (TIFF)\n'.format(
+                    filename, pagenumber)
+                jpglinks += 'File:{0}|page {1} (JPG)\n'.format(
+                    (filename[:-4] + ".jpg"), pagenumber)
+            else:
+                jpglinks += 'File:{0}|page {1} (JPG)\n'.format(
+                    filename, pagenumber)
+        m['other_pages'] = "<gallery>\n{0}</gallery>\n<br/>\n----\n<br/>\n<gallery>\n{1}</gallery>".format(
+            tiflinks, jpglinks)
+    return file.wikitext_template.template.format(**m)
+
+
+class StandinMetadata(object):
+    """A metadata backend giving every item the same, fairly full, record."""
+
+    def expect(self, arcids):
+        pass
+
+    def metadata(self, arcid):
+        m = narabot.ItemMetadata(arcid)
+        m.description = " ".join(["Letter from the Secretary of War to the "
+                                  "Governor of the Territory [regarding] the "
+                                  "survey of the boundary line"] * 2)
+        m.scope_and_content = "This file contains letters {and} reports. " * 20
+        m.general_notes = "Note #1"
+        m.local_id = "77-1234"
+        m.creators = ["Department of War. Office of the Secretary."]
+        m.authors = [narabot.Author(10, "Smith, John [Capt.]")]
+        m.places = [narabot.Place(22, "Paris (France)", "48.85", "2.35")]
+        m.contacts = ["National Archives at College Park"]
+        m.dates = "1865-4-9"
+        m.record_group = narabot.RecordGroup(77, "Record Group 77")
+        m.series = narabot.Series(44, "Series X")
+        m.file_unit = None
+        m.variant_control_numbers = ["HMS Entry Number: A1 17"]
+        m.hierarchy_key = (77, 44)
+        return m
+
+
+def make_item(pages):
+    # the item's chatter about its pages is not part of the timing
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    try:
+        return narabot.Item(305799, *[narabot.TIFFFile("p{0}.tif".format(n))
+                                      for n in range(pages)])
+    finally:
+        sys.stdout = stdout
+
+def render_item(item, wikitext=lambda file: file.wikitext):
+    # upload_file asks for each page's wikitext three times (printed, as the
+    # comment and as the text), and then again for its JPEG version
+    for file in item.files:
+        for n in range(3):
+            wikitext(file)
+        jpeg = file.jpeg_file()
+        for n in range(3):
+            wikitext(jpeg)
+
+def bench_wikitext(page_counts=(25, 50, 100, 200, 400, 800),
+                   legacy_limit=200):
+    narabot.Item.metadata_backend = StandinMetadata()
+    item = make_item(5)
+    for file in item.files:
+        assert file.wikitext == legacy_wikitext(file)
+        assert file.jpeg_file().wikitext == legacy_wikitext(file.jpeg_file())
+    # every page lists all the others, so the text itself grows with the item
+    # unless they are listed on a page index of their own
+    print("  pages   legacy ms/item  ms/page   cached ms/item  ms/page   "
+          "kB/page   indexed kB/page")
+    for pages in page_counts:
+        legacy = None
+        if pages <= legacy_limit:
+            legacy, result = timed(render_item, make_item(pages),
+                                   legacy_wikitext)
+        item = make_item(pages)
+        cached, result = timed(render_item, item)
+        narabot.Item.page_index_title = narabot.PAGE_INDEX_TITLE
+        indexed = make_item(pages).files[0].wikitext
+        narabot.Item.page_index_title = None
+        print("  {0:5}   {1:>14}  {2:>7}   {3:14.1f}  {4:7.2f}   {5:7.1f}"
+              "   {6:15.1f}"
+              .format(pages,
+                      "{0:.1f}".format(legacy * 1000) if legacy else "-",
+                      "{0:.2f}".format(legacy * 1000 / pages)
+                      if legacy else "-",
+                      cached * 1000, cached * 1000 / pages,
+                      len(item.files[0].wikitext) / 1024.0,
+                      len(indexed) / 1024.0))
+    narabot.Item.metadata_backend = None
+
+
+###############################################################################
+#  template: rendering descriptions from metadata records, escaping included,
+#  with the compiled template against str.format and uncompiled patterns
+#
+
+def legacy_escape(s):
+    return re.sub(r'([#<>\[\]\|\{\}|]+)', r'<nowiki>\1</nowiki>', s)
+
+def description_fields(record, escape):
+    m = dict.fromkeys(narabot.WikitextTemplate.fields, u"")
+    m['title'] = escape(record.description)
+    m['scope_and_content'] = escape(record.scope_and_content)
+    m['general_notes'] = escape(record.general_notes)
+    m['arc'] = record.arcid
+    m['local_identifier'] = escape(record.local_id)
+    m['creator'] = "<br/>\n".join(map(escape, record.creators))
+    m['author'] = "<br/>\n".join(
+        "{{{{NARA-Author|{0}|{1}}}}}".format(escape(author.name), author.id)
+        for author in record.authors)
+    m['location'] = "<br/>\n".join(map(escape, record.contacts))
+    m['date'] = record.dates
+    m['record_group_arc'], m['record_group'] = record.record_group
+    m['series_arc'], m['series'] = record.series
+    m['variant_control_numbers'] = \
+        "\n*".join(map(escape, record.variant_control_numbers))
+    return m
+
+def render_legacy(template, records):
+    for record in records:
+        template.format(**description_fields(record, legacy_escape))
+
+def render_compiled(template, records):
+    for record in records:
+        template.render(description_fields(record, narabot.wikitext_escape))
+
+INFORMATION_TEMPLATE = (
+    u"== {{{{int:filedesc}}}} ==\n"
+    u"{{{{Information\n"
+    u"|description={title}\n\n{scope_and_content}\n"
+    u"|date={date}\n"
+    u"|source=National Archives Identifier {arc} ({local_identifier})\n"
+    u"|author={author}\n"
+    u"|other versions={other_versions}\n"
+    u"}}}}\n\n"
+    u"== {{{{int:license-header}}}} ==\n"
+    u"{{{{PD-USGov}}}}\n")
+
+def bench_template(renders=100000):
+    backend = StandinMetadata()
+    records = [backend.metadata(305799 + n) for n in range(renders)]
+    for name, template in [("NARA-image-full",
+                            narabot.File.wikitext_template.template),
+                           ("Information", INFORMATION_TEMPLATE)]:
+        compiled = narabot.WikitextTemplate(template)
+        for record in records[:100]:
+            assert template.format(**description_fields(
+                record, legacy_escape)) == compiled.render(
+                    description_fields(record, narabot.wikitext_escape))
+        legacy, result = timed(render_legacy, template, records)
+        fast, result = timed(render_compiled, compiled, records)
+        print("  {0:<16} {1} renders: str.format {2:.2f}s ({3:.1f} us), "
+              "compiled {4:.2f}s ({5:.1f} us)".format(
+                  name, renders, legacy, legacy / renders * 1e6,
+                  fast, fast / renders * 1e6))
+
+
+###############################################################################
+#  plaintext: soup_to_plaintext and normalize_dates against the recursive
+#  extractor and the escape-then-three-passes date rewriting they replaced,
+#  checked for the same output on random input first
+#
+
+def legacy_soup_to_plaintext(element):
+    out = ""
+    for child in element.children:
+        if isinstance(child, NavigableString):
+            out += str(child) + ' '
+        elif child.name == 'br':
+            out += '\n' + legacy_soup_to_plaintext(child)
+        elif child.name == 'p':
+            out += '\n\n' + legacy_soup_to_plaintext(child)
+        else:
+            out += legacy_soup_to_plaintext(child)
+    return out
+
+def legacy_dates(date_str):
+    date_str = legacy_escape(date_str)
+    date_str = re.sub(r'(?<![{=|])\b(\d+)/(\d+)/(\d+)', r"\3-\1-\2", date_str)
+    date_str = re.sub(r'(?<![{=|])\b(\d+)/(\d+)', r"\2-\1", date_str)
+    date_str = re.sub(r'(?<![{=|])\b(\d+)', r"\1", date_str)
+    return date_str
+
+def random_dates(rng):
+    pieces = ['1', '12', '1865', '/', '/', '-', '=', ' ', 'ca. ', ', ',
+              '[', ']', '|', '{', '}', '#', '<', '>', 'a', u'\xe9']
+    return u"".join(rng.choice(pieces) for n in range(rng.randint(0, 24)))
+
+def random_markup(rng, depth=0):
+    parts = []
+    for n in range(rng.randint(0, 4)):
+        choice = rng.random()
+        if choice < 0.4 or depth > 6:
+            parts.append(rng.choice([u"Smith, John", u"1/2/1865", u" ",
+                                     u"caf\xe9", u"a &amp; b"]))
+        elif choice < 0.55:
+            parts.append(u"<br/>")
+        else:
+            tag = rng.choice(['p', 'span', 'div', 'b'])
+            parts.append(u"<{0}>{1}</{0}>".format(
+                tag, random_markup(rng, depth + 1)))
+    return u"".join(parts)
+
+def scope_note(paragraphs, nesting=1):
+    paragraph = (u"<p>" + u"<span>" * nesting +
+                 u"Correspondence, reports and maps of the survey of the "
+                 u"boundary line, 1/2/1865 - 4/1866.<br/>See also the "
+                 u"related series." + u"</span>" * nesting + u"</p>\n")
+    return u"<div class='genPad'>" + paragraph * paragraphs + u"</div>"
+
+def outcome(function, *args):
+    # the result, or the type of the error raised (as by str() on non-ASCII
+    # text, which both extractors have always done)
+    try:
+        return function(*args)
+    except Exception as e:
+        return type(e)
+
+def bench_plaintext(samples=20000):
+    rng = random.Random(1865)
+    for n in range(samples):
+        text = random_dates(rng)
+        assert narabot.normalize_dates(text) == legacy_dates(text), text
+    for n in range(samples // 10):
+        soup = BeautifulSoup(u"<div>" + random_markup(rng) + u"</div>",
+                             narabot.HTML_PARSER).div
+        assert outcome(narabot.soup_to_plaintext, soup) == \
+            outcome(legacy_soup_to_plaintext, soup), soup
+    print("  same output on {0} date strings and {1} fragments"
+          .format(samples, samples // 10))
+
+    for paragraphs, nesting in [(100, 1), (1000, 1), (10000, 1), (1, 2000)]:
+        soup = BeautifulSoup(scope_note(paragraphs, nesting),
+                             narabot.HTML_PARSER).div
+        new, text = timed(narabot.soup_to_plaintext, soup)
+        try:
+            old, legacy_text = timed(legacy_soup_to_plaintext, soup)
+            assert text == legacy_text
+            old = "{0:8.1f} ms".format(old * 1000)
+        except RuntimeError:
+            old = "recursion limit"
+        print("  {0:6.0f} kB note, {1:4} deep: recursive {2:>15}, "
+              "iterative {3:8.1f} ms".format(len(text) / 1024.0, nesting + 2,
+                                            old, new * 1000))
+        soup.decompose()
+
+    dates = [u"1/2/1865, 3/4/1866 - 5/1866 [ca.] {{sic}} #{0}".format(n)
+             for n in range(samples * 5)]
+    old, result = timed(lambda: [legacy_dates(d) for d in dates])
+    new, result = timed(lambda: [narabot.normalize_dates(d) for d in dates])
+    print("  {0} date fields: escape and three passes {1:.2f}s, one pass "
+          "{2:.2f}s".format(len(dates), old, new))
+
+
+###############################################################################
+#  metadata: the one-pass, strained extraction of item pages against the
+#  scraper it replaced, on the pages in "sample pages"
+#
+
+sample_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "sample pages")
+
+def legacy_lines(soup, label):
+    try:
+        lines = narabot.soup_to_plaintext(
+            soup.find(text=label).parent.next_sibling).split('\n')
+        return [line.strip() for line in lines if line.strip()]
+    except:
+        return None
+
+def legacy_item_metadata(html, arcid):
+    # the fields of an item page as the Item properties used to scrape them,
+    # each from the whole page
+    soup = BeautifulSoup(html, narabot.HTML_PARSER)
+    m = {}
+    try:
+        m['description'] = list(soup.find('strong', 'sFC'))[0].strip()
+    except:
+        m['description'] = None
+    m['authors'] = [
+        narabot.Author(int(re.match(r'^ExecuteRelatedPeopleSearch\?id=(\d+)&',
+                                    a['href']).group(1)), a.text)
+        for a in soup.findAll('a',
+                              href=re.compile(r'^ExecuteRelatedPeopleSearch\?'))]
+    m['place_links'] = [
+        (int(re.match(r'^ExecuteRelatedGeographicalSearch\?id=(\d+)&',
+                      a['href']).group(1)), a.text, a['href'])
+        for a in soup.findAll('a',
+                              href=re.compile(r'^ExecuteRelatedGeographical'))]
+    for name in ('scope', 'hierarchy'):
+        link = soup.find('a', href=re.compile('showFullDescriptionTabs/' +
+                                              name))
+        m[name + '_href'] = link['href'] if link else None
+    ancestor_link = re.compile(r'ExternalIdSearch\?id=(\d+)')
+    links = [(int(ancestor_link.search(a['href']).group(1)), a.text)
+             for a in soup.findAll('a', href=ancestor_link)]
+    links = [(id, text) for id, text in links if id != arcid]
+    m['hierarchy_key'] = tuple(sorted(set(id for id, text in links))) \
+        if any('file unit' in text.lower() for id, text in links) else None
+    try:
+        m['contacts'] = [
+            re.sub(' PHONE:.*$', '', contact.strip()) for contact in
+            narabot.soup_to_plaintext(soup.find('p', 'contacts')).split('\n')
+            if re.sub(' PHONE:.*$', '', contact.strip())]
+    except:
+        m['contacts'] = None
+    m['creators'] = legacy_lines(soup, 'Creator(s):')
+    m['variant_control_numbers'] = legacy_lines(soup,
+                                                'Variant Control Number(s):')
+    date_field = soup.find(text='Production Date(s):') or \
+                 soup.find(text='Coverage Dates:') or \
+                 soup.find(text='Broadcast Date(s):')
+    m['dates'] = legacy_dates(
+        date_field.parent.parent.next_sibling.text.strip()) \
+        if date_field else None
+    try:
+        m['general_notes'] = soup.find(text='General Note(s):') \
+            .parent.next_sibling.text.strip()
+    except:
+        m['general_notes'] = None
+    try:
+        m['local_id'] = re.match('ARC Identifier (.+) / Local Identifier (.+)',
+                                 soup.find('strong', 'arcID').text).group(2)
+    except:
+        m['local_id'] = None
+    return m
+
+def legacy_genpad(html):
+    return BeautifulSoup(html, narabot.HTML_PARSER,
+                         parse_only=SoupStrainer('div', 'genPad'))
+
+def bench_metadata(repeat=50):
+    pages = {}
+    for filename in sorted(os.listdir(sample_dir)):
+        kind, id = os.path.splitext(filename)[0].split('-')
+        pages[kind, int(id)] = open(os.path.join(sample_dir, filename)).read()
+    compared = 0
+    for (kind, id), html in sorted(pages.items()):
+        if kind == 'item':
+            legacy = legacy_item_metadata(html, id)
+            record = narabot.extract_item_metadata(html, id)
+            for field, value in legacy.items():
+                assert getattr(record, field) == value, \
+                    (id, field, getattr(record, field), value)
+                compared += 1
+        elif kind == 'scope':
+            assert narabot.extract_scope_and_content(html) == \
+                legacy_genpad(html).text.strip()
+            compared += 1
+        elif kind == 'place':
+            coords = legacy_genpad(html).find(text="Coordinates:") \
+                .parent.next_sibling.text
+            assert narabot.extract_place_coordinates(html) == \
+                re.search('\((.+), (.+)\)', coords).groups()
+            compared += 1
+        elif kind == 'hierarchy':
+            record_group, series, file_unit = narabot.extract_hierarchy(html)
+            soup = BeautifulSoup(html, narabot.HTML_PARSER)
+            treel3 = soup.find('span', 'treel3')
+            assert file_unit == narabot.FileUnit(
+                treel3.find('span', 'hierlocalid').strong.text,
+                treel3.find('span', 'hierRecord').text)
+            assert series.name == soup.find('span', 'treel2') \
+                .find('span', 'hierRecord').text.strip()
+            assert record_group.id == int(soup.find('span', 'treel1')
+                                          .find('span', 'hierlocalid')
+                                          .strong.text)
+            compared += 1
+    print("  same fields as the old scraper: {0} fields of {1} sample pages"
+          .format(compared, len(pages)))
+
+    for (kind, id), html in sorted(pages.items()):
+        if kind != 'item':
+            continue
+        old, result = timed(lambda: [legacy_item_metadata(html, id)
+                                     for n in range(repeat)])
+        new, result = timed(lambda: [narabot.extract_item_metadata(html, id)
+                                     for n in range(repeat)])
+        print("  {0:17} ({1:3.0f} kB): whole page {2:6.2f} ms, one strained "
+              "pass {3:6.2f} ms".format("item-{0}.html".format(id),
+                                        len(html) / 1024.0,
+                                        old * 1000 / repeat,
+                                        new * 1000 / repeat))
+
+
+###############################################################################
+#  harvest: the sample items scraped into a harvest file and read back with
+#  HarvestBackend give the same wikitext, and reading it back only
+#  decompresses the blocks of the items looked up
+#
+
+def quietly(function, *args):
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    try:
+        return function(*args)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+def item_wikitext(arcid):
+    item = narabot.Item(arcid, narabot.TIFFFile("p0.tif"),
+                        narabot.TIFFFile("p1.tif"))
+    return [file.wikitext for file in item.files]
+
+def write_manifest(filename, arcids):
+    with open(filename, 'w') as f:
+        for arcid in arcids:
+            f.write("{0}/p0.tif {0}\n".format(arcid))
+
+def seed_page_cache(cache):
+    # the sample pages, under the URLs the scraper would fetch them from;
+    # returns the arcids of the items with a title and all of their pages
+    pages = {}
+    for filename in os.listdir(sample_dir):
+        kind, id = os.path.splitext(filename)[0].split('-')
+        pages[kind, int(id)] = open(os.path.join(sample_dir, filename)).read()
+    arcids = []
+    for (kind, id), html in pages.items():
+        if kind != 'item':
+            continue
+        record = narabot.extract_item_metadata(html, id)
+        links = [('item', id, 'http://arcweb.archives.gov/arc/action/'
+                              'ExternalIdSearch?id=' + str(id))]
+        for name in ('hierarchy', 'scope'):
+            href = getattr(record, name + '_href')
+            if href:
+                links.append((name, id, 'http://arcweb.archives.gov' + href))
+        for place_id, name, href in record.place_links:
+            links.append(('place', place_id,
+                          'http://arcweb.archives.gov/arc/action/' + href))
+        if record.description and all((kind, id) in pages
+                                      for kind, id, url in links):
+            for kind, id, url in links:
+                cache.put(url, pages[kind, id])
+            arcids.append(record.arcid)
+    return sorted(arcids)
+
+class InterruptedMetadata(StandinMetadata):
+    """The standin records, with a ^C at the lookup of arcid interrupt."""
+
+    def __init__(self, interrupt):
+        self.interrupt = interrupt
+
+    def metadata(self, arcid):
+        if arcid == self.interrupt:
+            raise KeyboardInterrupt
+        return StandinMetadata.metadata(self, arcid)
+
+def harvested_lines(filename):
+    return sum(1 for line in gzip.open(filename) if line.strip())
+
+def check_resumed_harvests(scratch, items=1000, interrupt=400):
+    manifest = os.path.join(scratch, "resumed.txt")
+    harvested = os.path.join(scratch, "resumed.json.gz")
+    write_manifest(manifest, range(1, items + 1))
+
+    # stopped with ^C: the items harvested so far are kept
+    narabot.Item.metadata_backend = InterruptedMetadata(interrupt)
+    try:
+        quietly(narabot.harvest, manifest, harvested)
+    except KeyboardInterrupt:
+        pass
+    assert len(narabot.HarvestBackend(harvested).offsets) == interrupt - 1
+    narabot.Item.metadata_backend = StandinMetadata()
+    quietly(narabot.harvest, manifest, harvested)
+    assert len(narabot.HarvestBackend(harvested).offsets) == items
+    assert harvested_lines(harvested) == items
+
+    # killed: the last block is cut short, cut off and harvested again
+    offsets = narabot.HarvestBackend(harvested).offsets.values()
+    last = max(offset for offset, n in offsets)
+    with open(harvested, 'r+b') as f:
+        f.truncate(os.path.getsize(harvested) - 100)
+    backend = quietly(narabot.HarvestBackend, harvested)
+    assert backend.truncated_at == last
+    assert len(backend.offsets) == sum(1 for offset, n in offsets
+                                       if offset != last)
+    quietly(narabot.harvest, manifest, harvested)
+    assert len(narabot.HarvestBackend(harvested).offsets) == items
+    assert harvested_lines(harvested) == items
+
+    # blocks appended after one cut short, or damaged, are not dropped
+    # without a word
+    with open(harvested, 'r+b') as f:
+        f.truncate(backend.truncated_at + 100)
+    with open(harvested, 'ab') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as member:
+            member.write(json.dumps(
+                StandinMetadata().metadata(items + 1).to_dict()) + '\n')
+    for damage in (None, 'x' * 50):
+        if damage:
+            with open(harvested, 'r+b') as f:
+                f.seek(100)
+                f.write(damage)
+        try:
+            quietly(narabot.HarvestBackend, harvested)
+        except IOError:
+            pass
+        else:
+            raise AssertionError("a corrupt harvest was read")
+    print("  harvest of {0} items resumed after ^C at item {1}, and after "
+          "being killed, without loss".format(items, interrupt))
+
+def bench_harvest(items=20000, lookups=2000):
+    scratch = tempfile.mkdtemp()
+    saved = (narabot.Item.page_cache, narabot.Item.metadata_backend,
+             narabot.Item.hierarchy_cache, narabot.Item.place_resolver)
+    try:
+        narabot.Item.page_cache = narabot.PageCache(
+            os.path.join(scratch, "cache"), offline=True)
+        arcids = seed_page_cache(narabot.Item.page_cache)
+        scraped = dict((arcid, quietly(item_wikitext, arcid))
+                       for arcid in arcids)
+        manifest = os.path.join(scratch, "manifest.txt")
+        harvested = os.path.join(scratch, "harvest.json.gz")
+        write_manifest(manifest, arcids)
+        quietly(narabot.harvest, manifest, harvested)
+        narabot.Item.page_cache = None
+        narabot.Item.metadata_backend = narabot.HarvestBackend(harvested)
+        # a hierarchy cache of its own, filled from the harvest alone
+        for cache in (narabot.HierarchyCache(), narabot.HierarchyCache()):
+            narabot.Item.hierarchy_cache = cache
+            for arcid in arcids:
+                assert quietly(item_wikitext, arcid) == scraped[arcid], arcid
+
+        narabot.Item.metadata_backend = StandinMetadata()
+        standin = dict((arcid, quietly(item_wikitext, arcid))
+                       for arcid in (1, 2, items))
+        write_manifest(manifest, range(1, items + 1))
+        os.remove(harvested)
+        elapsed, result = timed(quietly, narabot.harvest, manifest, harvested)
+        print("  harvested {0} items in {1:.2f}s, {2:.0f} kB".format(
+            items, elapsed, os.path.getsize(harvested) / 1024.0))
+        narabot.Item.metadata_backend = narabot.HarvestBackend(harvested)
+        for cache in (narabot.HierarchyCache(), narabot.HierarchyCache()):
+            narabot.Item.hierarchy_cache = cache
+            for arcid, wikitext in standin.items():
+                assert quietly(item_wikitext, arcid) == wikitext, arcid
+        print("  same wikitext read back from the harvest: {0} sample items "
+              "scraped, {1} from a backend".format(len(arcids), len(standin)))
+        check_resumed_harvests(scratch)
+        rng = random.Random(0)
+        for order, wanted in (("in order", range(1, lookups + 1)),
+                              ("at random", [rng.randint(1, items)
+                                             for n in range(lookups)])):
+            elapsed, backend = timed(narabot.HarvestBackend, harvested)
+            read, result = timed(lambda: [backend.metadata(arcid)
+                                          for arcid in wanted])
+            assert [m.arcid for m in result] == wanted
+            print("  {0} lookups {1:9}: index {2:6.1f} ms, reads {3:6.1f} ms,"
+                  " {4} blocks decompressed (of {5})".format(
+                      lookups, order, elapsed * 1000, read * 1000,
+                      backend.members_read,
+                      -(-items // narabot.HarvestBackend.block_size)))
+    finally:
+        (narabot.Item.page_cache, narabot.Item.metadata_backend,
+         narabot.Item.hierarchy_cache, narabot.Item.place_resolver) = saved
+        shutil.rmtree(scratch)
+
+
+###############################################################################
+#  opa: OpaApiBackend against opa-standin.py serving the descriptions in
+#  "sample records", checked field by field and, for the item also in
+#  "sample pages", for the same wikitext as scraping it
+#
+
+record_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "sample records")
+
+def opa_standin():
+    standin = imp.load_source('opa_standin', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "opa-standin.py"))
+    standin.StandinHandler.record_dir = record_dir
+    standin.StandinHandler.log_message = lambda self, *args: None
+    server = BaseHTTPServer.HTTPServer(('localhost', 0),
+                                       standin.StandinHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://localhost:{0}/api/v1".format(server.server_port)
+
+def bench_opa():
+    arcids = [305799, 2641497, 7368]
+    saved = (narabot.Item.page_cache, narabot.Item.metadata_backend,
+             narabot.Item.hierarchy_cache, narabot.Item.place_resolver)
+    scratch = tempfile.mkdtemp()
+    server, url = opa_standin()
+    try:
+        narabot.Item.page_cache = narabot.PageCache(scratch, offline=True)
+        seed_page_cache(narabot.Item.page_cache)
+        scraped = quietly(item_wikitext, 305799)
+        narabot.Item.page_cache = None
+        narabot.Item.hierarchy_cache = narabot.HierarchyCache()
+
+        for batch_size in (50, 1):
+            narabot.Item.place_resolver = narabot.PlaceResolver()
+            backend = narabot.OpaApiBackend(url, batch_size=batch_size)
+            narabot.Item.metadata_backend = backend
+            backend.expect(arcids)
+            items = [quietly(narabot.Item, arcid, narabot.TIFFFile("p0.tif"),
+                             narabot.TIFFFile("p1.tif"))
+                     for arcid in arcids]
+            elapsed, wikitext = timed(lambda: dict(
+                (item.arcid, [file.wikitext for file in item.files])
+                for item in items))
+            print("  {0} items, batch_size {1:2}: {2} requests in {3:.1f} ms"
+                  .format(len(arcids), batch_size, backend.requests,
+                          elapsed * 1000))
+
+        # the API gives the naId of the file unit where arcweb gives its
+        # local identifier; everything else is the same
+        assert wikitext[305799] == [
+            text.replace("|File unit ARC=F-1", "|File unit ARC=1234")
+            for text in scraped]
+
+        lange, newsreel = items[1], items[2]
+        assert [a.name for a in lange.authors] == \
+            ["Lange, Dorothea, 1895-1965", "Rothstein, Arthur"]
+        assert lange.places == [
+            narabot.Place(2001, "Arkansas", "34.8", "-92.2"),
+            narabot.Place(2002, "Mississippi River", None, None)]
+        assert 2002 not in narabot.Item.place_resolver.coordinates
+        assert lange.dates == "1937-1, 1937-12-31"
+        assert lange.general_notes == ("Caption from the original print.\n"
+                                       "Photographed for the Resettlement "
+                                       "Administration.")
+        assert lange.creators == ["Lange, Dorothea, 1895-1965"]
+        assert lange.file_unit is None
+        assert lange.series == narabot.Series(
+            521108, "Photographs of the Flood of 1937")
+        assert lange.record_group == narabot.RecordGroup(
+            69, "Record Group 69: Records of the Work Projects "
+                "Administration")
+        assert "|Date=1937-1, 1937-12-31\n" in wikitext[2641497][0]
+        assert newsreel.dates == "1959-10-12, 1959-10-15"
+        assert newsreel.variant_control_numbers == [
+            "NAIL Control Number: NWDNM(m)-200UN-32-817", "Agency ID: 32-817"]
+        assert newsreel.contacts[-1] == "College Park, MD 20740-6001"
+        assert newsreel.record_group == narabot.RecordGroup(
+            200, "Universal Newsreel Collection")
+        assert newsreel.places == [narabot.Place(3003, "Washington (D.C.)",
+                                                 "38.895", "-77.036")]
+        print("  same wikitext as scraping item 305799; single and multiple "
+              "values of {0} records mapped as expected".format(
+                  len(os.listdir(record_dir))))
+    finally:
+        (narabot.Item.page_cache, narabot.Item.metadata_backend,
+         narabot.Item.hierarchy_cache, narabot.Item.place_resolver) = saved
+        server.shutdown()
+        shutil.rmtree(scratch)
+
+
+###############################################################################
+#  upload: peak memory and time of posting a large file as a multipart form,
+#  streamed from disk against built in memory first
+#
+
+class UploadStandin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Takes uploads of any size, counting and discarding the bytes."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           UploadHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://localhost:{0}/w/api.php".format(self.server_port)
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        while length:
+            length -= len(self.rfile.read(min(length, 1024 * 1024)))
+        body = '{"upload": {"result": "Success"}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def post_form(url, filename, streamed):
+    form = narabot.MultiPartForm()
+    form.add_field('action', 'upload')
+    form.add_field('text', u"== {{int:filedesc}} ==\n" * 100)
+    with open(filename, 'rb') as f:
+        form.add_file('file', os.path.basename(filename), f)
+        # as upload_file used to: the whole form as one string
+        body = form if streamed else str(form)
+        narabot.Transport().open(
+            url, body, headers={'Content-type': form.get_content_type(),
+                                'Content-length': len(body)}).read()
+
+def peak_memory(function, *args):
+    # run in a child process of its own, so that each run's peak resident
+    # size is measured from the same start
+    def child(results):
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed, result = timed(function, *args)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put((elapsed, (peak - start) / 1024.0))
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=child, args=(results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def bench_upload(sizes_mb=(16, 64, 256)):
+    server = UploadStandin()
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes_mb:
+            filename = os.path.join(directory, "{0}.tif".format(size))
+            with open(filename, 'wb') as f:
+                for n in range(size):
+                    f.write(os.urandom(1024 * 1024))
+            for name, streamed in [("in memory", False), ("streamed", True)]:
+                elapsed, peak = peak_memory(post_form, server.url, filename,
+                                            streamed)
+                print("  {0:4} MB file, {1:<9}: {2:6.2f}s ({3:6.1f} MB/s), "
+                      "peak memory +{4:.1f} MB".format(size, name, elapsed,
+                                                      size / elapsed, peak))
+            os.remove(filename)
+    finally:
+        shutil.rmtree(directory)
+    server.shutdown()
+
+
+###############################################################################
+#  stash: chunked uploads against a stand-in for the upload stash, stopped
+#  and resumed, with the stash losing its file keys, and under --max-size
+#
+
+class StashStandin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Takes uploads in chunks into a stash (or in one go), and publishes them.
+
+    Once fail_after more chunks have been taken, the next one is answered
+    with a 500; a chunk for a file key the stash does not have (as after
+    forget()) gets the API's stashfailed error.  The bytes of the chunks
+    taken are counted, and the size of every request is kept.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           StashHandler)
+        self.stash = {}
+        self.published = {}
+        self.fail_after = None
+        self.chunk_bytes = 0
+        self.request_sizes = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://localhost:{0}/w/api.php".format(self.server_port)
+
+    def forget(self):
+        with self.lock:
+            self.stash.clear()
+
+
+class StashHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers['Content-Length'])
+        server.request_sizes.append(length)
+        if self.headers['Content-Type'].startswith('multipart/'):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST'})
+            params = dict((name, form[name].value) for name in form.keys())
+        else:
+            params = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        action = params['action']
+        if action == 'login':
+            reply = {'result': 'Success'}
+        elif action == 'query' and params.get('list') == 'allimages':
+            reply = {'allimages': []}
+        elif action == 'query':
+            reply = {'pages': {'-1': {'edittoken': 'token+\\'}}}
+        elif params.get('stash'):
+            with server.lock:
+                if server.fail_after == 0:
+                    server.fail_after = None
+                    return self.reply(500, '')
+                if server.fail_after:
+                    server.fail_after -= 1
+                key = params.get('filekey') or "key{0}".format(
+                    len(server.stash) + len(server.published))
+                if params.get('filekey') and key not in server.stash:
+                    return self.reply(200, json.dumps({'error': {
+                        'code': 'stashfailed',
+                        'info': "No chunked upload session with this key"}}))
+                data = server.stash.get(key, '')
+                assert int(params['offset']) == len(data)
+                data = server.stash[key] = data + params['chunk']
+                server.chunk_bytes += len(params['chunk'])
+            if len(data) < int(params['filesize']):
+                reply = {'result': 'Continue', 'offset': len(data),
+                         'filekey': key}
+            else:
+                reply = {'result': 'Success', 'filekey': key}
+        else:
+            with server.lock:
+                server.published[params['filename']] = params['file'] \
+                    if 'file' in params else server.stash.pop(params['filekey'])
+            reply = {'result': 'Success', 'filename': params['filename']}
+        self.reply(200, json.dumps({action: reply}))
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinFile(narabot.File):
+    canonical_extension = '.ogv'
+    needs_jpeg = False
+    wiki_filename = u"Stand-in upload.ogv"
+    os_filename = "Stand-in upload.ogv"
+    wikitext = u"== {{int:filedesc}} =="
+
+
+def stash_bot(server, state_filename, **options):
+    return quietly(lambda: narabot.UploadBot(
+        server.url, 'Bot', 'secret', state_filename=state_filename,
+        transport=narabot.Transport(), **options))
+
+def stash_upload(server, bot, filename, fail_after=None):
+    # the bytes of the chunks taken, and whether the upload went through
+    server.fail_after, server.chunk_bytes = fail_after, 0
+    try:
+        quietly(bot.upload_file, StandinFile(filename))
+    except urllib2.HTTPError:
+        return server.chunk_bytes, False
+    return server.chunk_bytes, True
+
+def bench_stash(size_mb=8, chunk_mb=1):
+    server = StashStandin()
+    directory = tempfile.mkdtemp()
+    mb = 1024 * 1024
+    try:
+        filename = os.path.join(directory, "upload.bin")
+        with open(filename, 'wb') as f:
+            for n in range(size_mb):
+                f.write(os.urandom(mb))
+        data = open(filename, 'rb').read()
+        state = os.path.join(directory, "state")
+        saved = lambda: json.load(open(state + '.chunks')).get(filename)
+        bot = lambda **options: stash_bot(server, state,
+                                          chunk_size=chunk_mb * mb, **options)
+
+        # stopped by a server error after three chunks, then again on the
+        # first chunk resumed (which keeps the offset saved), then resumed
+        sent, done = stash_upload(server, bot(), filename, fail_after=3)
+        assert not done and saved()['offset'] == 3 * chunk_mb * mb
+        sent, done = stash_upload(server, bot(), filename, fail_after=0)
+        assert not done and saved()['offset'] == 3 * chunk_mb * mb
+        sent, done = stash_upload(server, bot(), filename)
+        assert done and saved() is None
+        assert server.published[StandinFile.wiki_filename] == data
+        print("  {0} MB in {1} MB chunks, stopped twice: {2:.0f} MB sent on "
+              "resuming".format(size_mb, chunk_mb, float(sent) / mb))
+
+        # the stash lost the chunks stored before: started again
+        stash_upload(server, bot(), filename, fail_after=3)
+        server.forget()
+        server.published.clear()
+        sent, done = stash_upload(server, bot(), filename)
+        assert done and saved() is None
+        assert server.published[StandinFile.wiki_filename] == data
+        print("  {0} MB, its file key gone from the stash: {1:.0f} MB sent on "
+              "starting again".format(size_mb, float(sent) / mb))
+
+        # over --max-size though not over --chunk-size: chunked, and no
+        # request larger than --max-size (give or take the form's fields)
+        max_size = 3 * mb
+        del server.request_sizes[:]
+        os.remove(state + '.chunks')
+        sent, done = stash_upload(server, stash_bot(
+            server, state, chunk_size=2 * size_mb * mb, max_size=max_size),
+            filename)
+        assert done and server.published[StandinFile.wiki_filename] == data
+        assert max(server.request_sizes) < max_size + 4096
+        print("  {0} MB, --max-size 3 MB, --chunk-size {1} MB: largest request "
+              "{2:.2f} MB".format(size_mb, 2 * size_mb,
+                                  float(max(server.request_sizes)) / mb))
+    finally:
+        shutil.rmtree(directory)
+    server.shutdown()
+
+
+###############################################################################
+#  rate: API requests from many workers against a server which lags when it
+#  is sent too much at once, with a fixed window against the rate controller
+#
+
+class LaggedStandin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An API whose replicas fall behind when it is sent too much at once.
+
+    Up to capacity requests are served in service_time each; past that every
+    request takes proportionally longer and each one beyond capacity adds
+    lag_per_request seconds of replication lag, so that requests whose
+    maxlag is exceeded are turned away with a maxlag error (and those beyond
+    twice the capacity with a 503), both with a Retry-After of retry_after.
+    """
+    daemon_threads = True
+
+    def __init__(self, capacity=4, service_time=0.02, lag_per_request=2,
+                 retry_after=0.25):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           LaggedHandler)
+        self.capacity = capacity
+        self.service_time = service_time
+        self.lag_per_request = lag_per_request
+        self.retry_after = retry_after
+        self.active = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://localhost:{0}/w/api.php".format(self.server_port)
+
+
+class LaggedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        server = self.server
+        params = dict(urlparse.parse_qsl(
+            self.rfile.read(int(self.headers['Content-Length']))))
+        with server.lock:
+            server.active += 1
+            active = server.active
+        try:
+            lag = max(0, active - server.capacity) * server.lag_per_request
+            if active > 2 * server.capacity:
+                self.reply(503, '', {'Retry-After': server.retry_after})
+            elif 'maxlag' in params and lag > int(params['maxlag']):
+                self.reply(200, json.dumps({'error': {
+                    'code': 'maxlag', 'lag': lag,
+                    'info': "Waiting for a replica: {0} seconds lagged"
+                            .format(lag)}}),
+                    {'Retry-After': server.retry_after,
+                     'X-Database-Lag': lag,
+                     'MediaWiki-API-Error': 'maxlag'})
+            else:
+                time.sleep(server.service_time *
+                           max(1.0, float(active) / server.capacity))
+                action = params['action']
+                reply = {'result': 'Success'} if action == 'login' else {}
+                self.reply(200, json.dumps({action: reply}))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def reply(self, code, body, headers={}):
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixedWindow(narabot.RateController):
+    # as many requests at once as there are workers, whatever the server
+    # says (but still waiting for its Retry-After)
+    def __init__(self, max_window):
+        narabot.RateController.__init__(self, max_window, max_window)
+
+    def success(self, ticket, latency):
+        narabot.RateController.success(self, ticket, latency)
+        self.window = self.max_window
+
+    def throttle(self, ticket, wait):
+        narabot.RateController.throttle(self, ticket, wait)
+        self.window = self.max_window
+        self.interval = 0.0
+
+
+def make_bot(url, workers):
+    stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    try:
+        return narabot.UploadBot(url, 'Bot', 'secret', upload_workers=workers,
+                                 transport=narabot.Transport())
+    finally:
+        sys.stderr = stderr
+
+def query_in_workers(bot, requests, workers):
+    stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    try:
+        in_threads(lambda: [bot.api_request(action='query', meta='userinfo')
+                            for n in range(requests // workers)],
+                   workers)
+    finally:
+        sys.stderr = stderr
+
+def bench_rate(requests=480, workers=8):
+    server = LaggedStandin()
+    print("  server: {0} requests at once in {1:.0f} ms, lagged by {2}s per "
+          "request past that".format(server.capacity,
+                                     server.service_time * 1000,
+                                     server.lag_per_request))
+    for name, bot_workers, controller in [
+            ("1 worker", 1, None),
+            ("{0} workers, fixed".format(workers), workers, FixedWindow),
+            ("{0} workers, AIMD".format(workers), workers, None)]:
+        bot = make_bot(server.url, bot_workers)
+        if controller:
+            bot.rate = controller(bot_workers)
+        bot.rate.stats.clear()
+        elapsed, result = timed(query_in_workers, bot, requests, bot_workers)
+        stats = bot.rate.stats
+        print("  {0:<18}: {1:6.1f} requests/s, {2:3} of {3} turned away, "
+              "window {4:.1f}".format(name, requests / elapsed,
+                                      stats['throttled'], stats['requests'],
+                                      bot.rate.window))
+    server.shutdown()
+
+
+###############################################################################
+#  run the benchmarks named on the command line (or all of them)
+#
+
+benchmarks = [('transport', bench_transport),
+              ('wikitext', bench_wikitext),
+              ('template', bench_template),
+              ('plaintext', bench_plaintext),
+              ('metadata', bench_metadata),
+              ('harvest', bench_harvest),
+              ('opa', bench_opa),
+              ('upload', bench_upload),
+              ('stash', bench_stash),
+              ('rate', bench_rate)]
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name for name, bench in benchmarks]
+    for name, bench in benchmarks:
+        if name in names:
+            print("\n{0}:".format(name))
+            bench()
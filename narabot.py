@@ -16,21 +16,45 @@ from __future__ import print_function
 from bs4 import BeautifulSoup, NavigableString, SoupStrainer
 import cgi
 import cookielib
+import cPickle
 from datetime import date
+import gzip
 import hashlib
+import httplib
 from PIL import Image
 import itertools
 import json
+import mmap
 import mimetools
 import mimetypes
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import collections
 from collections import namedtuple
 import os
+import Queue
 import re
 import shutil
+import socket
+import StringIO
+import string
+import struct
 import sys
 import tempfile
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 #
 #  end imports
@@ -44,6 +68,10 @@ FileUnit = namedtuple('FileUnit', ['id', 'name'])
 Place = namedtuple('Place', ['id', 'name', 'latitude', 'longitude'])
 RecordGroup = namedtuple('RecordGroup', ['id', 'name'])
 Series = namedtuple('Series', ['id', 'name'])
+PageIndex = namedtuple('PageIndex', ['arcid', 'title', 'text'])
+
+OPA_API_URL = 'https://research.archives.gov/api/v1'
+PAGE_INDEX_TITLE = 'Template:NARA-pages/{arcid}'
 
 #
 #  end of variable declarations
@@ -51,96 +79,1632 @@ Series = namedtuple('Series', ['id', 'name'])
 #  begin class-independent function definitions
 #
 
+WIKITEXT_SPECIALS = re.compile(r'([#<>\[\]\|\{\}|]+)')
+
+def nowiki(match):
+    return '<nowiki>' + match.group(1) + '</nowiki>'
+
 def wikitext_escape(s):
-    return re.sub(r'([#<>\[\]\|\{\}|]+)', r'<nowiki>\1</nowiki>', s)
+    # one pass of the compiled pattern; a function is quicker to substitute
+    # with than a replacement template, which is expanded for every match
+    return WIKITEXT_SPECIALS.sub(nowiki, s)
+
+# runs of special characters, or numbers separated by slashes (dates) which
+# do not follow an '=' sign
+DATE_OR_SPECIALS = re.compile(r'([#<>\[\]\|\{\}|]+)|(?<!=)\b(\d+(?:/\d+)+)')
+
+def date_or_nowiki(match):
+    if match.group(1):
+        return '<nowiki>' + match.group(1) + '</nowiki>'
+    numbers = match.group(2).split('/')
+    if len(numbers) == 3:
+        return numbers[2] + '-' + numbers[0] + '-' + numbers[1]
+    if len(numbers) == 2:
+        return numbers[1] + '-' + numbers[0]
+    # longer runs are rewritten as they always were, month/day/year
+    # triples first and then any month/year pairs left over
+    text = re.sub(r'\b(\d+)/(\d+)/(\d+)', r"\3-\1-\2", match.group(2))
+    return re.sub(r'\b(\d+)/(\d+)', r"\2-\1", text)
+
+def normalize_dates(s):
+    """Escape s for wikitext, writing its m/d/y and m/y dates as y-m-d."""
+    return DATE_OR_SPECIALS.sub(date_or_nowiki, s)
+
+def memoized_property(method):
+    """Property computed once per object and kept in its metadata cache."""
+    name = method.__name__
+    def getter(self):
+        try:
+            value = self.metadata_cache[name]
+        except KeyError:
+            self.cache_misses += 1
+            value = self.metadata_cache[name] = method(self)
+        else:
+            self.cache_hits += 1
+        return value
+    getter.__name__ = name
+    getter.__doc__ = method.__doc__
+    return property(getter)
+
+def natural_key(s):
+    # sort key which orders embedded numbers numerically ("p2" before "p10")
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split(r'(\d+)', s)]
+
+def scan_directory(top, previous=None, listings=None):
+    """Recursively list (fullpath, size, mtime) for every file under top.
+
+    previous and listings map directory paths to {'mtime', 'files', 'subdirs'}
+    listings.  A directory whose mtime matches its entry in previous is taken
+    from there without being listed again (though its files are still stat()ed,
+    since a file rewritten in place leaves its directory's mtime alone);
+    every directory visited is recorded in listings.
+    """
+    found = []
+    pending = [os.path.abspath(top)]
+    while pending:
+        d = pending.pop()
+        mtime = os.stat(d).st_mtime
+        listing = previous and previous.get(d)
+        if not listing or listing['mtime'] != mtime:
+            listing = {'mtime': mtime, 'files': [], 'subdirs': []}
+            if scandir:
+                # DirEntry caches the stat results of the directory listing,
+                # which spares a stat() per file on most platforms
+                for entry in scandir(d):
+                    if entry.is_dir(follow_symlinks=False):
+                        listing['subdirs'].append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        listing['files'].append(
+                            (entry.path, st.st_size, st.st_mtime))
+            else:
+                for f in os.listdir(d):
+                    fullpath = os.path.join(d, f)
+                    if os.path.isdir(fullpath) and \
+                            not os.path.islink(fullpath):
+                        listing['subdirs'].append(fullpath)
+                    elif os.path.isfile(fullpath):
+                        st = os.stat(fullpath)
+                        listing['files'].append(
+                            (fullpath, st.st_size, st.st_mtime))
+        else:
+            files = []
+            for fullpath, size, file_mtime in listing['files']:
+                try:
+                    st = os.stat(fullpath)
+                except OSError:
+                    continue
+                files.append((fullpath, st.st_size, st.st_mtime))
+            listing = dict(listing, files=files)
+        if listings is not None:
+            listings[d] = listing
+        pending.extend(listing['subdirs'])
+        found.extend(tuple(f) for f in listing['files'])
+    return found
 
 def soup_to_plaintext(element):
-    out = ""
-    for child in element.children:
-        if isinstance(child, NavigableString):
-            out += str(child) + ' '
-        elif child.name == 'br':
-            out += '\n' + soup_to_plaintext(child)
-        elif child.name == 'p':
-            out += '\n\n' + soup_to_plaintext(child)
+    # walked with a stack of the elements being read rather than by
+    # recursion, so that deeply nested markup cannot exhaust the stack
+    out = []
+    append = out.append
+    stack = [iter(element.contents)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, NavigableString):
+                append(str(child) + ' ')
+            else:
+                if child.name == 'br':
+                    append('\n')
+                elif child.name == 'p':
+                    append('\n\n')
+                stack.append(iter(child.contents))
+                break
         else:
-            out += soup_to_plaintext(child)
-    return out
+            stack.pop()
+    return ''.join(out)
 
 #
 #  end of class-independent function definitions
 ###############################################################################
-#  begin the UPLOAD BATCH class definition
+#  begin the WIKITEXT TEMPLATE class definition
 #
 
-class Batch(set):
-    def __init__(self, index_filename, *directories):
-        f = open(index_filename)
-        
-        # create dictionary to hold filename/arcid from filelist as key-value pairs
-        print("\nUpload Manifest:")
-        upload_manifest = {}
-        lineno = 1  # track line number in filelist for error reporting
-        
-        # iterate through the filenames file pulling out filenames and arcids
-        for line in f:
-            m = re.match('^(.+)\s+([0-9]+)\r?$', line)
-            if m:
-                filename, arcid = m.groups()
-                upload_manifest[filename.lower()] = int(arcid)
-            else:
+class WikitextTemplate(object):
+    """A file description template, compiled once to be rendered many times.
+
+    Templates are written in str.format syntax (with literal braces doubled)
+    and may use any of the fields below.  Each is compiled into a single
+    %-format string, so that rendering a description is one substitution,
+    with no parsing of the template.
+    """
+
+    fields = ('title', 'scope_and_content', 'general_notes', 'arc',
+              'local_identifier', 'creator', 'author', 'place', 'location',
+              'date', 'record_group', 'record_group_arc', 'series',
+              'series_arc', 'file_unit', 'file_unit_arc',
+              'variant_control_numbers', 'tiff', 'other_versions',
+              'other_pages')
+
+    def __init__(self, template):
+        self.template = template
+        compiled = []
+        for literal, name, spec, conversion in \
+                string.Formatter().parse(template):
+            compiled.append(literal.replace(u'%', u'%%'))
+            if name is None:
+                continue
+            if name not in self.fields or spec or conversion:
+                raise ValueError("unknown field '{{{0}}}' in the wikitext "
+                                 "template".format(name))
+            compiled.append(u'%({0})s'.format(name))
+        self.compiled = u''.join(compiled)
+
+    @classmethod
+    def from_file(cls, filename):
+        return cls(open(filename).read().decode('utf-8'))
+
+    def render(self, fields):
+        return self.compiled % fields
+
+#
+#  end of WIKITEXT TEMPLATE class definition
+###############################################################################
+#  begin the METADATA EXTRACTION definitions
+#
+
+# use the fastest parser available; lxml is much faster than Python's own
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+
+class ItemMetadata(object):
+    """The metadata of an item, as extracted from its catalog pages.
+
+    Only these fields are kept, so that none of the parsed pages outlive
+    the extraction.  place_links holds (id, name, href) for each place, whose
+    coordinates are resolved separately; scope_href and hierarchy_href are
+    the links to the item's other description tabs.  Sources which give
+    them directly (such as OpaApiBackend) fill in places, scope_and_content
+    and the hierarchy instead.
+    """
+    __slots__ = ('arcid', 'description', 'authors', 'contacts', 'creators',
+                 'dates', 'general_notes', 'local_id', 'place_links',
+                 'variant_control_numbers', 'scope_href', 'hierarchy_href',
+                 'hierarchy_key', 'places', 'scope_and_content',
+                 'record_group', 'series', 'file_unit')
+
+    def __init__(self, arcid):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.arcid = arcid
+
+    # records are passed back from parser processes, which needs these for
+    # a class with __slots__
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    # the fields held as namedtuples, lists of them, and plain tuples (which
+    # JSON turns into lists)
+    tuple_fields = {'record_group': RecordGroup, 'series': Series,
+                    'file_unit': FileUnit}
+    list_fields = {'authors': Author, 'places': Place}
+    plain_tuple_fields = ('hierarchy_key',)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, d):
+        m = cls(d['arcid'])
+        for name in cls.__slots__:
+            value = d.get(name)
+            if value is not None and name in cls.tuple_fields:
+                value = cls.tuple_fields[name](*value)
+            elif value is not None and name in cls.list_fields:
+                value = [cls.list_fields[name](*v) for v in value]
+            elif value is not None and name in cls.plain_tuple_fields:
+                value = tuple(value)
+            setattr(m, name, value)
+        return m
+
+
+class ParseTimer(object):
+    """Accumulates the number of pages parsed and the time spent on them."""
+
+    def __init__(self):
+        self.pages = 0
+        self.seconds = 0.0
+        self.__lock = threading.Lock()
+
+    def __call__(self, extract):
+        def timed(*args):
+            start = time.time()
+            try:
+                return extract(*args)
+            finally:
+                self.add(time.time() - start)
+        timed.__name__ = extract.__name__
+        timed.__doc__ = extract.__doc__
+        return timed
+
+    def add(self, seconds):
+        with self.__lock:
+            self.pages += 1
+            self.seconds += seconds
+
+    def report(self):
+        print("Parsing: {0} pages in {1:.2f}s ({2:.1f} ms/page, {3})".format(
+            self.pages, self.seconds,
+            1000 * self.seconds / self.pages if self.pages else 0,
+            HTML_PARSER))
+
+parse_timer = ParseTimer()
+
+
+class ParserPool(object):
+    """Runs the page extractors in a pool of worker processes.
+
+    The workers are handed the raw html and send back the small records
+    extracted from it, so parsing is spread over several cores whenever
+    several threads (such as those of a MetadataPrefetcher) parse at once.
+    """
+
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes)
+
+    def __call__(self, extract, *args):
+        # the time spent in the workers is not seen by this process's
+        # parse_timer, so the time waited on them is counted instead
+        start = time.time()
+        try:
+            return self.pool.apply(extract, args)
+        finally:
+            parse_timer.add(time.time() - start)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def find_lines(label, soup):
+    # the non-empty lines of the field following a label
+    try:
+        lines = soup_to_plaintext(soup.find(text=label).parent.next_sibling)
+    except:
+        return None
+    return [line.strip() for line in lines.split('\n') if line.strip()]
+
+# the only parts of an item page the metadata is read from: the title and
+# identifier (strong.sFC and strong.arcID), the rows of labels and values
+# (with p.contacts among them) and the links
+ITEM_PAGE_PARTS = SoupStrainer(['strong', 'p', 'tr', 'a'])
+
+@parse_timer
+def extract_item_metadata(html, arcid):
+    """Extract an ItemMetadata from the html of an item page in one pass."""
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=ITEM_PAGE_PARTS)
+    m = ItemMetadata(arcid)
+    
+    try:
+        m.description = list(soup.find('strong', 'sFC'))[0].strip()
+    except:
+        pass
+    
+    m.authors = []
+    m.place_links = []
+    ancestors = set()
+    file_unit_linked = False
+    for a in soup.findAll('a', href=True):
+        href = a['href']
+        author = re.match(r'^ExecuteRelatedPeopleSearch\?id=(\d+)&', href)
+        place = re.match(r'^ExecuteRelatedGeographicalSearch\?id=(\d+)&',
+                         href)
+        ancestor = re.search(r'ExternalIdSearch\?id=(\d+)', href)
+        if author:
+            m.authors.append(Author(int(author.group(1)), a.text))
+        elif place:
+            m.place_links.append((int(place.group(1)), a.text, href))
+        elif 'showFullDescriptionTabs/scope' in href:
+            m.scope_href = m.scope_href or href
+        elif 'showFullDescriptionTabs/hierarchy' in href:
+            m.hierarchy_href = m.hierarchy_href or href
+        elif ancestor and int(ancestor.group(1)) != arcid:
+            # the other descriptions the item page links to (those of its
+            # file unit, series and record group), which siblings share
+            ancestors.add(int(ancestor.group(1)))
+            file_unit_linked |= 'file unit' in a.text.lower()
+    # without a link to the file unit, items in different file units of a
+    # series would share a key (and items directly in a series cannot be
+    # told from them), so such items have their hierarchy page read
+    m.hierarchy_key = tuple(sorted(ancestors)) if file_unit_linked else None
+    
+    contacts = soup.find('p', 'contacts')
+    if contacts:
+        m.contacts = []
+        for contact in soup_to_plaintext(contacts).split('\n'):
+            contact = re.sub(' PHONE:.*$', '', contact.strip())
+            if contact:
+                m.contacts.append(contact)
+    
+    m.creators = find_lines('Creator(s):', soup)
+    m.variant_control_numbers = find_lines('Variant Control Number(s):', soup)
+    
+    date_field = soup.find(text='Production Date(s):') or \
+                 soup.find(text='Coverage Dates:') or \
+                 soup.find(text='Broadcast Date(s):') or \
+                 None
+    if date_field:
+        m.dates = normalize_dates(
+            date_field.parent.parent.next_sibling.text.strip())
+    
+    try:
+        m.general_notes = soup.find(text='General Note(s):') \
+            .parent.next_sibling.text.strip()
+    except:
+        pass
+    
+    try:
+        arcid_field = soup.find('strong', 'arcID').text
+        m.local_id = re.match('ARC Identifier (.+) / Local Identifier (.+)',
+                              arcid_field).group(2)
+    except:
+        pass
+    
+    soup.decompose()
+    return m
+
+@parse_timer
+def extract_hierarchy(html):
+    """Extract the (record group, series, file unit) from a hierarchy page."""
+    soup = BeautifulSoup(html, HTML_PARSER,
+                         parse_only=SoupStrainer('span',
+                                                 re.compile('^treel[123]$')))
+    try:
+        treel1 = soup.find('span', 'treel1')
+        name = treel1.span.strong.text.strip() + " " + \
+               treel1.find('span', 'hierRecord').text.strip()
+        id = int(treel1.find('span', 'hierlocalid').strong.text)
+        record_group = RecordGroup(id, name)
+    except:
+        record_group = None
+    try:
+        treel2 = soup.find('span', 'treel2')
+        name = treel2.find('span', 'hierRecord').text.strip()
+        id = int(treel2.find('span', 'hierlocalid').strong.text)
+        series = Series(id, name)
+    except:
+        series = None
+    try:
+        treel3 = soup.find('span', 'treel3')
+        name = treel3.find('span', 'hierRecord').text
+        id = treel3.find('span', 'hierlocalid').strong.text
+        file_unit = FileUnit(id, name)
+    except:
+        file_unit = None
+    soup.decompose()
+    return record_group, series, file_unit
+
+@parse_timer
+def extract_scope_and_content(html):
+    """Extract the scope and content note from a scope page."""
+    soup = BeautifulSoup(html, HTML_PARSER,
+                         parse_only=SoupStrainer('div', 'genPad'))
+    text = soup.text.strip()
+    soup.decompose()
+    return text
+
+@parse_timer
+def extract_place_coordinates(html):
+    """Extract the (latitude, longitude) of a place from its page."""
+    soup = BeautifulSoup(html, HTML_PARSER,
+                         parse_only=SoupStrainer('div', 'genPad'))
+    try:
+        coords = soup.find(text="Coordinates:").parent.next_sibling.text
+        m = re.search('\((.+), (.+)\)', coords)
+        return m.group(1), m.group(2)
+    except:
+        # the place has no coordinates
+        return None, None
+    finally:
+        soup.decompose()
+
+#
+#  end of the METADATA EXTRACTION definitions
+###############################################################################
+#  begin the MANIFEST INDEX class definition
+#
+
+class ManifestIndex(object):
+    """On-disk, memory-mapped filename->arcid index compiled from a manifest.
+
+    The index is a header followed by fixed-width records sorted by
+    lowercased filename, so lookups are a binary search over the mapped file.
+    It is recompiled whenever the manifest's size or mtime changes.
+    """
+    magic = b'NARAIDX1'
+    header = struct.Struct('<8sQdII')   # magic, size, mtime, count, keylen
+    arcid_field = struct.Struct('<Q')
+    manifest_line = re.compile(r'^(.+)\s+([0-9]+)\r?$')
+
+    def __init__(self, manifest_filename, index_filename=None):
+        self.manifest_filename = manifest_filename
+        self.index_filename = index_filename or manifest_filename + '.idx'
+        if not self.is_current():
+            self.compile()
+        self.__file = open(self.index_filename, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, self.size, self.mtime, self.count, self.keylen = \
+            self.header.unpack_from(self.__map, 0)
+        self.record_size = self.keylen + self.arcid_field.size
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, filename):
+        return self.get(filename) is not None
+
+    def is_current(self):
+        try:
+            with open(self.index_filename, 'rb') as f:
+                magic, size, mtime, count, keylen = \
+                    self.header.unpack(f.read(self.header.size))
+        except (IOError, struct.error):
+            return False
+        st = os.stat(self.manifest_filename)
+        return (magic == self.magic and size == st.st_size and
+                mtime == st.st_mtime)
+
+    def compile(self):
+        print("\nCompiling manifest index \"{0}\" ...".format(
+            self.index_filename))
+        st = os.stat(self.manifest_filename)
+        arcids = {}
+        duplicates = 0
+        conflicts = 0
+        for lineno, line in enumerate(open(self.manifest_filename), 1):
+            m = self.manifest_line.match(line)
+            if not m:
                 raise IOError("bad mapping on line {0}: {1}"
                               .format(lineno, line))
-            # Report the files and arcids captured from each line
-            print("LINE {0}: FILE: {1}\tARC ID: {2}".format(lineno, filename, arcid))
-            lineno += 1
+            filename, arcid = m.groups()
+            key = filename.lower()
+            arcid = int(arcid)
+            if key in arcids:
+                if arcids[key] == arcid:
+                    duplicates += 1
+                    print("duplicate filename on line {0}: {1}"
+                          .format(lineno, filename), file=sys.stderr)
+                else:
+                    conflicts += 1
+                    print("conflicting arcid on line {0}: {1} is {2}, "
+                          "was {3}".format(lineno, filename, arcid,
+                                           arcids[key]), file=sys.stderr)
+            # as with a plain dictionary, later lines win
+            arcids[key] = arcid
+        keylen = max([len(key) for key in arcids] or [0])
+        
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self.header.pack(self.magic, st.st_size, st.st_mtime,
+                                     len(arcids), keylen))
+            for key in sorted(arcids):
+                f.write(key.ljust(keylen, b'\0'))
+                f.write(self.arcid_field.pack(arcids[key]))
+        if os.path.exists(self.index_filename):
+            os.remove(self.index_filename)
+        os.rename(tmp_filename, self.index_filename)
+        print("Indexed {0} files ({1} duplicates, {2} conflicts)"
+              .format(len(arcids), duplicates, conflicts))
+
+    def arcids(self):
+        # every distinct arcid in the manifest, in order
+        arcids = set()
+        for n in range(self.count):
+            offset = self.header.size + n * self.record_size + self.keylen
+            arcids.add(self.arcid_field.unpack_from(self.__map, offset)[0])
+        return sorted(arcids)
+
+    def get(self, filename, default=None):
+        key = filename.lower()
+        if len(key) > self.keylen:
+            return default
+        key = key.ljust(self.keylen, b'\0')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.header.size + mid * self.record_size
+            record_key = self.__map[offset:offset + self.keylen]
+            if record_key < key:
+                lo = mid + 1
+            elif record_key > key:
+                hi = mid
+            else:
+                return self.arcid_field.unpack_from(
+                    self.__map, offset + self.keylen)[0]
+        return default
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+#
+#  end of MANIFEST INDEX class definition
+###############################################################################
+#  begin the HTTP TRANSPORT class definitions
+#
+
+class Response(object):
+    """A response read in full by Transport, in the manner of urllib2's."""
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.__body = StringIO.StringIO(body)
+
+    def read(self, size=-1):
+        return self.__body.read(size)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+
+class Transport(object):
+    """HTTP client shared by the catalog scraper, the OPA API and the bot.
+
+    Connections are kept alive and pooled per host, responses are asked for
+    gzip or deflate encoded and decoded on receipt, and the requests and bytes
+    sent to each host are counted.  Cookies go to the jar given with each
+    request (or to the transport's own jar), so that independent sessions can
+    share the connections.  Errors are raised as urllib2.HTTPError, and
+    redirects followed, as with a urllib2 opener.
+    """
+
+    connection_classes = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+    max_redirects = 5
+    block_size = 1024 * 1024
+
+    def __init__(self, timeout=None, max_idle=8, user_agent="narabot.py"):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.user_agent = user_agent
+        self.jar = cookielib.CookieJar()
+        self.hosts = {}
+        self.__idle = collections.defaultdict(list)
+        self.__lock = threading.Lock()
+
+    def __connection(self, scheme, host, fresh=False):
+        with self.__lock:
+            if self.__idle[scheme, host] and not fresh:
+                return self.__idle[scheme, host].pop(), True
+        if self.timeout is None:
+            connection = self.connection_classes[scheme](host)
+        else:
+            connection = self.connection_classes[scheme](
+                host, timeout=self.timeout)
+        self.__count(host, connections=1)
+        return connection, False
+
+    def __release(self, scheme, host, connection):
+        with self.__lock:
+            if len(self.__idle[scheme, host]) < self.max_idle:
+                self.__idle[scheme, host].append(connection)
+                return
+        connection.close()
+
+    def __count(self, host, **counts):
+        with self.__lock:
+            stats = self.hosts.setdefault(host, collections.Counter())
+            stats.update(counts)
+
+    def open(self, url, data=None, headers=None, jar=None):
+        """Send a request (a POST if there is data) and return the response.
+
+        data is a string, or a file-like object to be sent as it is read
+        (with its Content-Length among the headers).
+        """
+        if jar is None:
+            jar = self.jar
+        for redirect in range(self.max_redirects + 1):
+            request = urllib2.Request(url, data, headers or {})
+            request.add_header('User-Agent', self.user_agent)
+            request.add_header('Accept-Encoding', 'gzip, deflate')
+            jar.add_cookie_header(request)
+            code, msg, message, body = self.__send(request)
+            response = Response(url, code, msg, message, body)
+            jar.extract_cookies(response, request)
+            if code in (301, 302, 303, 307) and message.get('Location'):
+                url = urlparse.urljoin(url, message['Location'])
+                if code != 307:
+                    data = None
+                continue
+            if code >= 300:
+                raise urllib2.HTTPError(url, code, msg, message,
+                                        StringIO.StringIO(body))
+            return response
+        raise urllib2.HTTPError(url, code, "too many redirects", message,
+                                StringIO.StringIO(body))
+
+    def __send(self, request):
+        scheme = request.get_type()
+        host = request.get_host()
+        method = 'POST' if request.has_data() else 'GET'
+        data = request.get_data()
+        if data is not None and not request.has_header('Content-type'):
+            request.add_unredirected_header(
+                'Content-type', 'application/x-www-form-urlencoded')
+        headers = dict(request.header_items())
+        connection, reused = self.__connection(scheme, host)
+        try:
+            response = self.__exchange(connection, method, request, data,
+                                       headers)
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            # a kept-alive connection may have been closed by the server
+            # meanwhile; the request gets one more try on a new one, if its
+            # body can be read again
+            if not reused or (hasattr(data, 'read') and
+                              not hasattr(data, 'seek')):
+                raise
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            connection, reused = self.__connection(scheme, host, fresh=True)
+            response = self.__exchange(connection, method, request, data,
+                                       headers)
+        raw = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self.__release(scheme, host, connection)
+        if hasattr(data, 'read'):
+            sent = int(headers.get('Content-length', 0))
+        else:
+            sent = len(data or '')
+        self.__count(host, requests=1, bytes_in=len(raw), bytes_out=sent)
+        return (response.status, response.reason, response.msg,
+                self.decode(raw, response.getheader('Content-Encoding')))
+
+    def __exchange(self, connection, method, request, data, headers):
+        if not hasattr(data, 'read'):
+            connection.request(method, request.get_selector(), data, headers)
+            return connection.getresponse()
+        # a file-like body (such as a MultiPartForm) is sent as it is read,
+        # block_size bytes at a time, rather than in httplib's 8 kB blocks
+        connection.putrequest(method, request.get_selector(),
+                              skip_accept_encoding=True)
+        for header, value in headers.items():
+            connection.putheader(header, value)
+        connection.endheaders()
+        while True:
+            block = data.read(self.block_size)
+            if not block:
+                break
+            connection.send(block)
+        return connection.getresponse()
+
+    @staticmethod
+    def decode(body, encoding):
+        if encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                # some servers send a raw deflate stream, without the header
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+    def close(self):
+        with self.__lock:
+            for connections in self.__idle.values():
+                for connection in connections:
+                    connection.close()
+            self.__idle.clear()
+
+    def report(self):
+        for host in sorted(self.hosts):
+            stats = self.hosts[host]
+            print("HTTP {0}: {1} requests on {2} connections, {3:.1f} kB in, "
+                  "{4:.1f} kB out".format(host, stats['requests'],
+                                          stats['connections'],
+                                          stats['bytes_in'] / 1024.0,
+                                          stats['bytes_out'] / 1024.0))
+
+#
+#  end of the HTTP TRANSPORT class definitions
+###############################################################################
+#  begin the PREFETCHER class definitions
+#
+
+class HostLimiter(object):
+    """Bounds the number of concurrent requests made to each host."""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.__semaphores = {}
+        self.__lock = threading.Lock()
+
+    def slot(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.__lock:
+            if host not in self.__semaphores:
+                self.__semaphores[host] = \
+                    threading.BoundedSemaphore(self.per_host)
+            return self.__semaphores[host]
+
+
+class MetadataPrefetcher(object):
+    """Iterates over items, resolving the metadata of the next few ahead.
+
+    Up to lookahead items beyond the one being uploaded are handed to a pool
+    of worker threads which scrape their metadata; items are still yielded in
+    their original order.
+    """
+
+    def __init__(self, items, lookahead=4, workers=None):
+        self.items = items
+        self.lookahead = lookahead
+        self.workers = workers or lookahead
+        self.__tasks = Queue.Queue()
+
+    def __work(self):
+        while True:
+            item, done = self.__tasks.get()
+            item.prefetch()
+            done.set()
+
+    def __submit(self, item):
+        done = threading.Event()
+        self.__tasks.put((item, done))
+        return item, done
+
+    def __iter__(self):
+        for n in range(self.workers):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+        items = iter(self.items)
+        pending = collections.deque(self.__submit(item) for item in
+                                    itertools.islice(items, self.lookahead))
+        while pending:
+            item, done = pending.popleft()
+            # keep the queue topped up before waiting on this item
+            for item_ahead in itertools.islice(items, 1):
+                pending.append(self.__submit(item_ahead))
+            while not done.is_set():
+                done.wait(1)
+            yield item
+
+#
+#  end of the PREFETCHER class definitions
+###############################################################################
+#  begin the PAGE CACHE class definition
+#
+
+class PageCache(object):
+    """Disk cache of catalog pages, keyed by URL.
+
+    Each page is stored under the SHA1 of its URL, with a small JSON file of
+    metadata beside it.  Entries older than ttl seconds are revalidated with
+    a conditional GET, using the ETag and Last-Modified headers of the
+    original response, and only fetched again if the page has changed; once
+    the cache grows beyond max_size bytes, the least recently used entries
+    are evicted.  In offline mode a miss is an error instead of a fetch (and
+    expired entries are used as they are).
+
+    What is extracted from a page can be cached beside it as well, so that a
+    page which is still fresh, or has not been modified, is not parsed again;
+    record_version is to be raised whenever the extractors change what they
+    return.
+    """
+
+    record_version = 2
+
+    def __init__(self, directory, ttl=None, max_size=None, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.revalidated = 0
+        self.evicted = 0
+        self.reused = 0
+        self.__lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(size for path, size, mtime
+                        in scan_directory(directory))
+
+    def __path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url):
+        # returns the cached body and metadata of url, or (None, None)
+        path = self.__path(url)
+        try:
+            meta = json.load(open(path + '.json'))
+            body = open(path, 'rb').read()
+            # the mtime of an entry records when it was last used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # missing, or evicted by another thread while being read
+            return None, None
+        return body, meta
+
+    def is_fresh(self, meta):
+        return self.ttl is None or time.time() - meta['fetched'] <= self.ttl
+
+    def put(self, url, body, headers=None):
+        path = self.__path(url)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass    # created by another thread meanwhile
+        self.__replace(path, body)
+        # whatever was extracted from the old body is no good any more
+        self.__replace(path + '.record', None)
+        self.__write_meta(url, headers)
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict()
+
+    def __replace(self, path, data):
+        # write (or, with data None, remove) a file of an entry, keeping
+        # the size of the cache up to date
+        if data is not None:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+        replaced = 0
+        if os.path.exists(path):
+            try:
+                replaced = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                replaced = 0    # evicted by another thread meanwhile
+        if data is not None:
+            os.rename(path + '.tmp', path)
+        with self.__lock:
+            self.size += (len(data) if data is not None else 0) - replaced
+
+    def __extracted(self, url, body, extract, record):
+        # the record extracted from the body of url, parsed only if it has
+        # not been cached since the body was
+        if record is None:
+            return extract(body)
+        path = self.__path(url) + '.record'
+        key = [self.record_version, record]
+        try:
+            with open(path, 'rb') as f:
+                if cPickle.load(f) == key:
+                    value = cPickle.load(f)
+                    with self.__lock:
+                        self.reused += 1
+                    return value
+        except Exception:
+            pass    # missing, stale or unreadable: parsed again
+        value = extract(body)
+        try:
+            self.__replace(path, cPickle.dumps(key, 2) +
+                                 cPickle.dumps(value, 2))
+        except (IOError, OSError, cPickle.PicklingError):
+            pass
+        return value
+
+    def touch(self, url, headers=None):
+        # a page which has not changed since it was cached is good for
+        # another ttl seconds
+        self.__write_meta(url, headers)
+
+    def __write_meta(self, url, headers):
+        headers = headers or {}
+        meta = {'url': url,
+                'fetched': time.time(),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+        self.__replace(self.__path(url) + '.json', json.dumps(meta))
+
+    def fetch(self, url, download, extract=None, record=None):
+        """Return the body of url, calling download(headers) if need be.
+
+        download is called with a dictionary of extra request headers and
+        returns a urllib2 response; a 304 response to a conditional request
+        raises urllib2.HTTPError as usual.  With extract, what it returns for
+        the body is returned instead, and cached as the record named record.
+        """
+        if extract is None:
+            extract = lambda body: body
+        body, meta = self.get(url)
+        if body is not None and (self.offline or self.is_fresh(meta)):
+            with self.__lock:
+                self.hits += 1
+            return self.__extracted(url, body, extract, record)
+        if body is None:
+            if self.offline:
+                raise IOError("'{0}' is not cached (offline mode)"
+                              .format(url))
+            with self.__lock:
+                self.misses += 1
+            response = download({})
+        else:
+            with self.__lock:
+                self.expired += 1
+            conditions = {}
+            if meta.get('etag'):
+                conditions['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                conditions['If-Modified-Since'] = meta['last_modified']
+            try:
+                response = download(conditions)
+            except urllib2.HTTPError as e:
+                if e.code != 304:
+                    raise
+                with self.__lock:
+                    self.revalidated += 1
+                self.touch(url, {'ETag': e.info().get('ETag',
+                                                      meta.get('etag')),
+                                 'Last-Modified': meta.get('last_modified')})
+                return self.__extracted(url, body, extract, record)
+        body = response.read()
+        self.put(url, body, response.info())
+        return self.__extracted(url, body, extract, record)
+
+    def evict(self):
+        # drop the least recently used entries until the cache is back down
+        # to 90% of its maximum size
+        with self.__lock:
+            entries = {}
+            for path, size, mtime in scan_directory(self.directory):
+                key = os.path.splitext(path)[0]
+                last_used, total = entries.get(key, (0, 0))
+                entries[key] = (max(last_used, mtime), total + size)
+            self.size = sum(total for last_used, total in entries.values())
+            for key in sorted(entries, key=lambda k: entries[k][0]):
+                if self.size <= self.max_size * 0.9:
+                    break
+                for path in (key, key + '.json', key + '.record'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.size -= entries[key][1]
+                self.evicted += 1
+
+    def report(self):
+        lookups = self.hits + self.misses + self.expired
+        print("Page cache: {0} hits, {1} misses ({2:.1%} hit rate), "
+              "{3} expired ({4} not modified), {5} evicted, {6} bytes, "
+              "{7} pages not parsed again"
+              .format(self.hits, self.misses,
+                      float(self.hits) / lookups if lookups else 0,
+                      self.expired, self.revalidated, self.evicted,
+                      self.size, self.reused))
+
+#
+#  end of PAGE CACHE class definition
+###############################################################################
+#  begin the PLACE RESOLVER class definition
+#
+
+class PlaceResolver(object):
+    """Batch-wide store of place coordinates, keyed by arcweb place id.
+
+    Coordinates are looked up once per place: concurrent requests for the
+    same place wait for the first one, and, given a filename, coordinates
+    are kept in a JSON-lines file for later runs.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.coordinates = {}
+        self.fetches = 0
+        self.saved = 0
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            for line in open(filename):
+                if line.strip():
+                    id, latitude, longitude = json.loads(line)
+                    self.coordinates[id] = (latitude, longitude)
+
+    def resolve(self, id, lookup):
+        """Return the (latitude, longitude) of place id.
+
+        lookup() is called to find them if they are not known yet; if it
+        raises, so does this, for every request waiting on that lookup (and
+        the place is looked up again next time).
+        """
+        with self.__lock:
+            if id in self.coordinates:
+                self.saved += 1
+                return self.coordinates[id]
+            pending = self.__pending.get(id)
+            if pending:
+                self.saved += 1
+            else:
+                self.fetches += 1
+                event = self.__pending[id] = threading.Event()
+                event.error = None
+        if pending:
+            pending.wait()
+            if pending.error:
+                raise pending.error[0], pending.error[1], pending.error[2]
+            return self.coordinates[id]
+        try:
+            coordinates = lookup()
+            self.store(id, coordinates)
+            return coordinates
+        except Exception:
+            event.error = sys.exc_info()
+            raise
+        finally:
+            with self.__lock:
+                self.__pending.pop(id).set()
+
+    def store(self, id, coordinates):
+        with self.__lock:
+            self.coordinates[id] = coordinates
+            if self.filename:
+                with open(self.filename, 'a') as f:
+                    print(json.dumps([id] + list(coordinates)), file=f)
+
+    def report(self):
+        print("Places: {0} looked up, {1} lookups saved".format(
+            self.fetches, self.saved))
+
+#
+#  end of PLACE RESOLVER class definition
+###############################################################################
+#  begin the HIERARCHY CACHE class definition
+#
+
+class HierarchyCache(object):
+    """Record group, series and file unit of items, keyed by their ancestors."""
+
+    def __init__(self):
+        self.hierarchies = {}
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            hierarchy = self.hierarchies.get(key)
+            if hierarchy is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return hierarchy
+
+    def put(self, key, hierarchy):
+        with self.__lock:
+            self.hierarchies[key] = hierarchy
+
+    def report(self):
+        print("Hierarchies: {0} parsed, {1} taken from a sibling".format(
+            self.misses, self.hits))
+
+#
+#  end of HIERARCHY CACHE class definition
+###############################################################################
+#  begin the OPA API BACKEND class definition
+#
+
+def as_list(value):
+    # the API gives a single value where an array has only one element
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def opa_date(date):
+    # month/day/year parts of a date, written year-month-day as the dates
+    # scraped from arcweb are
+    if not date:
+        return ""
+    return "-".join(str(date[part]) for part in ('year', 'month', 'day')
+                    if date.get(part))
+
+
+class OpaApiBackend(object):
+    """Item metadata from the OPA public API, many arcids per request.
+
+    The arcids of a batch are announced in order with expect(); when the
+    metadata of one of them is asked for and it has not been fetched yet, it
+    is fetched along with the next batch_size - 1 expected arcids.  With a
+    record_dir, every description received is also written there as
+    <naId>.json, to be served again by opa-standin.py.
+    """
+
+    def __init__(self, api_url=OPA_API_URL, batch_size=50, record_dir=None):
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.record_dir = record_dir
+        self.requests = 0
+        self.__expected = collections.deque()
+        self.__records = {}
+        self.__lock = threading.Lock()
+
+    def expect(self, arcids):
+        with self.__lock:
+            self.__expected.extend(arcids)
+
+    def metadata(self, arcid):
+        with self.__lock:
+            if arcid not in self.__records:
+                arcids = [arcid]
+                while self.__expected and len(arcids) < self.batch_size:
+                    next_arcid = self.__expected.popleft()
+                    if next_arcid not in self.__records and \
+                            next_arcid not in arcids:
+                        arcids.append(next_arcid)
+                self.__fetch(arcids)
+            # each record is only asked for once (and then kept by its item)
+            record = self.__records.pop(arcid, None)
+        if record is None:
+            raise IOError("arcid #{0} was not found by the API".format(arcid))
+        return record
+
+    def query(self, **params):
+        params.setdefault('rows', self.batch_size)
+        url = self.api_url + '?' + urllib.urlencode(params)
+        self.requests += 1
+        reply = json.load(Item.transport.open(url))
+        reply = reply.get('opaResponse', reply)
+        return as_list(reply.get('results', {}).get('result'))
+
+    def __fetch(self, arcids):
+        results = self.query(naIds=",".join(str(a) for a in arcids),
+                             resultTypes='item,itemAv,fileUnit',
+                             resultFields='description',
+                             rows=len(arcids))
+        descriptions = {}
+        for result in results:
+            description = result['description']
+            for level in ('item', 'itemAv', 'fileUnit'):
+                if level in description:
+                    naId = int(result.get('@naId') or
+                               description[level]['naId'])
+                    descriptions[naId] = description[level]
+            if self.record_dir:
+                with open(os.path.join(self.record_dir, "{0}.json".format(
+                        result.get('@naId'))), 'w') as f:
+                    json.dump(result, f)
+        self.__resolve_places(descriptions.values())
+        for naId, description in descriptions.items():
+            self.__records[naId] = self.to_metadata(naId, description)
+
+    def __resolve_places(self, descriptions):
+        # look the coordinates of all the places not already known up at once
+        resolver = Item.place_resolver
+        place_ids = set()
+        for description in descriptions:
+            for place in as_list(description.get('geographicReferenceArray',
+                                                 {}).get('geographicPlaceName')):
+                if int(place['naId']) not in resolver.coordinates:
+                    place_ids.add(int(place['naId']))
+        if not place_ids:
+            return
+        for result in self.query(naIds=",".join(str(i) for i in place_ids),
+                                 resultTypes='geographicSubject',
+                                 rows=len(place_ids)):
+            place = result.get('geographicSubject', {})
+            latitude = place.get('latitude')
+            longitude = place.get('longitude')
+            m = re.search(r'\((.+), (.+)\)', place.get('coordinates') or '')
+            if m:
+                latitude, longitude = m.groups()
+            resolver.store(int(result.get('@naId') or place['naId']),
+                           (latitude, longitude))
+
+    def to_metadata(self, arcid, d):
+        """Map an API description onto the fields of an ItemMetadata."""
+        m = ItemMetadata(arcid)
+        m.description = d.get('title')
+        m.local_id = d.get('localIdentifier')
+        m.scope_and_content = d.get('scopeAndContentNote')
+        m.general_notes = d.get('generalNote')
+        if isinstance(m.general_notes, list):
+            m.general_notes = "\n".join(m.general_notes)
         
-        # create dictionary to hold filenames from upload directory
-        item_filenames = {}
+        m.authors = [Author(int(c['contributor']['naId']),
+                            c['contributor']['termName'])
+                     for c in as_list(d.get('personalContributorArray', {})
+                                      .get('personalContributor'))]
+        m.places = []
+        for place in as_list(d.get('geographicReferenceArray', {})
+                             .get('geographicPlaceName')):
+            id = int(place['naId'])
+            # only what the API returned is stored (by __resolve_places);
+            # a place it has no coordinates for is left to be looked up
+            # again by later runs
+            latitude, longitude = Item.place_resolver.coordinates.get(
+                id, (None, None))
+            m.places.append(Place(id, place['termName'], latitude, longitude))
+        m.variant_control_numbers = [
+            "{0}: {1}".format(v['type']['termName'], v['number'])
+            for v in as_list(d.get('variantControlNumberArray', {})
+                             .get('variantControlNumber'))]
         
-        # create list for tracking extra files not in the filelist
-        self.unknown_filenames = []
+        m.contacts = []
+        for unit in as_list(d.get('referenceUnitArray', {})
+                            .get('referenceUnit')):
+            m.contacts.append(unit.get('name'))
+            m.contacts.extend(filter(None, [unit.get('address1'),
+                                            unit.get('address2')]))
+            if unit.get('city'):
+                m.contacts.append("{0}, {1} {2}".format(
+                    unit.get('city'), unit.get('state', ''),
+                    unit.get('postCode', '')).strip())
         
-        # iterate through the specified directories
-        for d in directories:
-            print("\nSearching directory \"{0}\" for files to upload ...".format(d))
-            # for each file found therein
-            for f in os.listdir(d):
-                # construct the full-path filename and basename,
-                # joining relative directory and filename to the abspath
-                fullpath = os.path.abspath(os.path.join(d, f))
-                print("Full path = {0}".format(fullpath))
-                basename = os.path.basename(os.path.join(d, f.lower()))
-                print("Basename = {0}".format(basename))
-                
-                # look in the filename_arcids dictionary for the basename
-                # and lookup the arcid for that file
-                if basename in upload_manifest:
-                    arcid = upload_manifest[basename]
-                    
-                    # if arcid is already found in item_filenames dictionary,
-                    # attach it to that item, otherwise add it as its own item
-                    if arcid in item_filenames:
-                        item_filenames[arcid].append(fullpath)
-                        item_filenames[arcid].sort()
-                    else:
-                        item_filenames[arcid] = [fullpath]
-                
-                # add any files not found in filelist to the unknowns list
-                else:
-                    self.unknown_filenames.append(fullpath)
+        dates = [opa_date(date) for date in
+                 as_list(d.get('productionDateArray', {})
+                         .get('proposableQualifiableDate'))]
+        if not any(dates) and d.get('coverageDates'):
+            coverage = d['coverageDates']
+            dates = [opa_date(coverage.get('coverageStartDate')) + " - " +
+                     opa_date(coverage.get('coverageEndDate'))]
+        if not any(dates):
+            dates = [opa_date(date) for date in
+                     as_list(d.get('broadcastDateArray', {})
+                             .get('proposableQualifiableDate'))]
+        m.dates = wikitext_escape(", ".join(filter(None, dates))) or None
+        
+        # the hierarchy is nested in the description, from the file unit up
+        file_unit = d.get('parentFileUnit')
+        series = file_unit.get('parentSeries') if file_unit else \
+            d.get('parentSeries')
+        record_group = series and (series.get('parentRecordGroup') or
+                                   series.get('parentCollection'))
+        if file_unit:
+            m.file_unit = FileUnit(file_unit['naId'], file_unit['title'])
+        if series:
+            m.series = Series(int(series['naId']), series['title'])
+            m.creators = [c['creator']['termName'] for c in
+                          as_list(series.get('creatingOrganizationArray', {})
+                                  .get('creatingOrganization')) +
+                          as_list(series.get('creatingIndividualArray', {})
+                                  .get('creatingIndividual'))]
+        if record_group:
+            number = record_group.get('recordGroupNumber')
+            if number:
+                m.record_group = RecordGroup(
+                    int(number),
+                    "Record Group {0}: {1}".format(number,
+                                                   record_group['title']))
+            else:
+                m.record_group = RecordGroup(int(record_group['naId']),
+                                             record_group['title'])
+        return m
+
+    def report(self):
+        print("OPA API: {0} requests".format(self.requests))
 
-        print("\nCreated the following upload batch:")
-        for a, f in item_filenames.items():
-            print("\n{0}:".format(a))
-            print("\n".join(f for f in item_filenames[a]))
+#
+#  end of OPA API BACKEND class definition
+###############################################################################
+#  begin the HARVEST definitions
+#
 
-        # for each set of items (arcid: files) in the item_filenames dictionary
-        # iterate through the list of files, creating a file object for each and
-        # appending it to a list of files, which in turn is attached to an item
-        for arcid, filenames in item_filenames.items():
-            files = [File.from_extension(self, f) for f in filenames]
-            self.add(Item(arcid, *files))
+def harvest(index_filename, harvest_filename, prefetch=0):
+    """Resolve the metadata of every arcid in a manifest into a harvest file.
+
+    The harvest file is gzipped JSON lines, one ItemMetadata per line, in
+    gzip members of HarvestBackend.block_size lines; arcids already in it
+    are skipped, so an interrupted harvest can be resumed.  A member left
+    incomplete by a harvest that was killed is cut off, and its items
+    harvested again.
+    """
+    manifest = ManifestIndex(index_filename)
+    arcids = manifest.arcids()
+    manifest.close()
+    done = set()
+    if os.path.exists(harvest_filename):
+        harvested = HarvestBackend(harvest_filename)
+        done = set(harvested.offsets)
+        if harvested.truncated_at is not None:
+            print("cutting the incomplete block off \"{0}\" at byte {1}"
+                  .format(harvest_filename, harvested.truncated_at),
+                  file=sys.stderr)
+            with open(harvest_filename, 'r+b') as f:
+                f.truncate(harvested.truncated_at)
+    todo = [arcid for arcid in arcids if arcid not in done]
+    print("\nHarvesting metadata for {0} of {1} arcids into \"{2}\" ..."
+          .format(len(todo), len(arcids), harvest_filename))
+    
+    if Item.metadata_backend:
+        Item.metadata_backend.expect(todo)
+    items = (Item(arcid) for arcid in todo)
+    if prefetch:
+        items = MetadataPrefetcher(items, prefetch)
+    start = time.time()
+    count = 0
+    # the gzip members are appended one after another, and read back as one
+    # stream; each is short enough to be decompressed on its own when one
+    # of its items is looked up
+    with open(harvest_filename, 'ab') as raw:
+        f = None
+        try:
+            for item in items:
+                try:
+                    m = ItemMetadata(item.arcid)
+                    for name in Item.metadata_fields + ('hierarchy_key',):
+                        setattr(m, name, getattr(item, name))
+                except Exception as e:
+                    print("could not harvest arcid #{0}: {1}".format(
+                        item.arcid, e), file=sys.stderr)
+                    continue
+                if f is None:
+                    f = gzip.GzipFile(fileobj=raw, mode='wb')
+                f.write(json.dumps(m.to_dict()) + '\n')
+                count += 1
+                if count % HarvestBackend.block_size == 0:
+                    f.close()
+                    f = None
+        finally:
+            # the items harvested so far are kept, even on ^C
+            if f is not None:
+                f.close()
+    elapsed = time.time() - start
+    print("Harvested {0} items in {1:.2f}s ({2:.1f} items/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0))
+
+
+class HarvestBackend(object):
+    """Item metadata read back from a file written by harvest().
+
+    Only an index of the file is held in memory: the offset of the gzip
+    member each arcid's line is in, and where in the member it is.  Looking
+    an item up decompresses that member alone (at most block_size lines),
+    and the member last read is kept, since items are mostly looked up in
+    the order they were harvested.
+
+    A last member cut short (by a harvest that was killed) is left out, and
+    its offset kept as truncated_at; a file corrupt anywhere else raises
+    IOError.
+    """
+
+    block_size = 256
+
+    def __init__(self, harvest_filename):
+        self.filename = harvest_filename
+        self.offsets = {}
+        self.members_read = 0
+        self.truncated_at = None
+        self.__member = None, []
+        self.__lock = threading.Lock()
+        with open(harvest_filename, 'rb') as f:
+            offset = 0
+            while offset is not None:
+                next_offset, lines = self.__read_member(f, offset)
+                if lines is None:
+                    print("the last block of \"{0}\" is incomplete; its "
+                          "items are left out".format(harvest_filename),
+                          file=sys.stderr)
+                    self.truncated_at = offset
+                    break
+                for n, line in enumerate(lines):
+                    arcid = int(re.match(r'.*"arcid": (\d+)', line).group(1))
+                    self.offsets[arcid] = offset, n
+                offset = next_offset
+
+    @staticmethod
+    def __read_member(f, offset):
+        # the lines of the gzip member at offset (None if the file ends
+        # before the member does), and the offset of the next member (None
+        # after the last one)
+        f.seek(offset)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = []
+        read = 0
+        try:
+            while not decompressor.unused_data:
+                block = f.read(65536)
+                if not block:
+                    break
+                read += len(block)
+                data.append(decompressor.decompress(block))
+        except zlib.error as e:
+            raise IOError("\"{0}\" is corrupt at byte {1}: {2}".format(
+                f.name, offset, e))
+        if not read:
+            return None, []     # an empty file
+        if decompressor.unused_data:
+            next_offset = offset + read - len(decompressor.unused_data)
+        else:
+            # input past the end of a complete member is left unused, and
+            # is taken as more of the member otherwise
+            try:
+                decompressor.decompress('\0')
+            except zlib.error:
+                pass
+            if not decompressor.unused_data:
+                return None, None
+            next_offset = None
+        data.append(decompressor.flush())
+        return next_offset, [line for line in ''.join(data).split('\n')
+                             if line.strip()]
+
+    def expect(self, arcids):
+        pass
+
+    def metadata(self, arcid):
+        if arcid not in self.offsets:
+            raise IOError("arcid #{0} has not been harvested".format(arcid))
+        offset, n = self.offsets[arcid]
+        with self.__lock:
+            member_offset, lines = self.__member
+            if member_offset != offset:
+                with open(self.filename, 'rb') as f:
+                    next_offset, lines = self.__read_member(f, offset)
+                self.__member = offset, lines
+                self.members_read += 1
+        return ItemMetadata.from_dict(json.loads(lines[n]))
+
+    def report(self):
+        print("Harvest: {0} items, {1} blocks read".format(
+            len(self.offsets), self.members_read))
+
+#
+#  end of the HARVEST definitions
+###############################################################################
+#  begin the UPLOAD BATCH class definition
+#
+
+class Batch(object):
+    def __init__(self, index_filename, *directories, **options):
+        self.index_filename = index_filename
+        self.directories = directories
+        
+        # with a snapshot of the previous scan, unchanged directories are not
+        # listed again and the batch only contains items with new or modified
+        # files (see save_snapshot)
+        self.snapshot_filename = options.get('snapshot_filename')
+        # items are processed in arcid order, or, with order='folder',
+        # folder by folder, which keeps the siblings of a series or file unit
+        # together when the folders follow the archival arrangement
+        self.order = options.get('order', 'arcid')
+        previous = {'manifest': None, 'directories': {}, 'arcids': {}}
+        if self.snapshot_filename and \
+                os.path.exists(self.snapshot_filename):
+            previous = json.load(open(self.snapshot_filename))
+        self.listings = {}
+        
+        # create dictionary to hold the files found in the upload directories,
+        # keyed by lowercased basename; this is the only thing held in memory,
+        # so the size of the manifest does not matter
+        found_filenames = {}
+        self.file_stats = {}
+        
+        # scan the specified directories (and everything below them),
+        # each in its own thread
+        print("\nSearching {0} for files to upload ...".format(
+            ", ".join('"{0}"'.format(d) for d in directories)))
+        start = time.time()
+        pool = ThreadPool(max(len(directories), 1))
+        try:
+            scans = pool.map(lambda d: scan_directory(d,
+                                                      previous['directories'],
+                                                      self.listings),
+                             directories)
+        finally:
+            pool.close()
+        for fullpath, size, mtime in itertools.chain.from_iterable(scans):
+            basename = os.path.basename(fullpath).lower()
+            found_filenames.setdefault(basename, []).append(fullpath)
+            self.file_stats[fullpath] = (size, mtime)
+        elapsed = time.time() - start
+        print("Found {0} files in {1:.2f}s ({2:.0f} files/s)".format(
+            len(self.file_stats), elapsed,
+            len(self.file_stats) / elapsed if elapsed else 0))
+        
+        # look the files up in the compiled manifest index, which is only
+        # rebuilt when the manifest itself changes; if it has not changed
+        # since the snapshot, the arcids recorded there are still good
+        manifest = ManifestIndex(index_filename)
+        self.manifest_stamp = [manifest.size, manifest.mtime]
+        reuse_arcids = previous['manifest'] == self.manifest_stamp
+        previous_stats = {}
+        for listing in previous['directories'].values():
+            for fullpath, size, mtime in listing['files']:
+                previous_stats[fullpath] = (size, mtime)
+        self.arcids = {}
+        self.changed_filenames = set()
+        # files which were there last time but have been modified since
+        self.modified_filenames = set()
+        for basename, paths in found_filenames.items():
+            for fullpath in paths:
+                unchanged = previous_stats.get(fullpath) == \
+                    self.file_stats[fullpath]
+                if not unchanged and fullpath in previous_stats:
+                    self.modified_filenames.add(fullpath)
+                if unchanged and reuse_arcids:
+                    arcid = previous['arcids'].get(fullpath)
+                else:
+                    arcid = manifest.get(basename)
+                if self.snapshot_filename and (not unchanged or
+                        arcid != previous['arcids'].get(fullpath)):
+                    self.changed_filenames.add(fullpath)
+                self.arcids[fullpath] = arcid
+        manifest.close()
+        
+        # group the files by arcid, adding any files not found in filelist
+        # to the unknowns list; with a snapshot, only items which have a new
+        # or modified file are kept (with all of their files, so that their
+        # pages are still numbered correctly)
+        self.item_filenames = {}
+        self.unknown_filenames = []
+        for fullpath, arcid in self.arcids.items():
+            if arcid is not None:
+                self.item_filenames.setdefault(arcid, []).append(fullpath)
+            elif not self.snapshot_filename or \
+                    fullpath in self.changed_filenames:
+                self.unknown_filenames.append(fullpath)
+        if self.snapshot_filename:
+            changed_arcids = set(self.arcids[f]
+                                 for f in self.changed_filenames)
+            for arcid in list(self.item_filenames):
+                if arcid not in changed_arcids:
+                    del self.item_filenames[arcid]
+            print("{0} files are new or modified since the last scan"
+                  .format(len(self.changed_filenames)))
+        self.unknown_filenames.sort()
+        # each item is sorted once, in natural page order
+        for filenames in self.item_filenames.values():
+            filenames.sort(key=natural_key)
+        print("\nCreated an upload batch of {0} items".format(len(self)))
+
+    def __len__(self):
+        return len(self.item_filenames)
+
+    def __iter__(self):
+        # items are built on demand, so nothing but the filenames is held for
+        # items which have not been reached yet
+        if self.order == 'folder':
+            arcids = sorted(self.item_filenames, key=lambda arcid: (
+                natural_key(os.path.dirname(self.item_filenames[arcid][0])),
+                arcid))
+        else:
+            arcids = sorted(self.item_filenames)
+        if Item.metadata_backend:
+            Item.metadata_backend.expect(arcids)
+        for arcid in arcids:
+            files = [File.from_extension(self, f, self.file_stats[f][0])
+                     for f in self.item_filenames[arcid]]
+            yield Item(arcid, *files)
+
+    def save_snapshot(self):
+        # record this scan, to be compared against by the next one; this is
+        # only done once the batch has been uploaded, so that an interrupted
+        # run is scanned in full again
+        if not self.snapshot_filename:
+            return
+        snapshot = {'manifest': self.manifest_stamp,
+                    'directories': self.listings,
+                    'arcids': self.arcids}
+        tmp_filename = self.snapshot_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(snapshot, f)
+        if os.path.exists(self.snapshot_filename):
+            os.remove(self.snapshot_filename)
+        os.rename(tmp_filename, self.snapshot_filename)
 
 #
 #  end of BATCH class definition
@@ -149,17 +1713,49 @@ class Batch(set):
 #
 
 class Item(object):
+    # limits concurrent arcweb requests when items are prefetched in parallel
+    host_limiter = None
+    # HTTP connections shared by all items, the OPA API backend and the bot
+    transport = Transport()
+
+    # on-disk cache of the arcweb pages scraped, shared by all items
+    page_cache = None
+
+    # coordinates of the places items refer to, shared by all items
+    place_resolver = PlaceResolver()
+
+    # record groups, series and file units, keyed by hierarchy_key
+    hierarchy_cache = HierarchyCache()
+
+    # pool of processes to parse the pages in, if any
+    parser_pool = None
+
+    # source of metadata to use instead of scraping arcweb (OpaApiBackend)
+    metadata_backend = None
+
+    # title of the page listing the pages of a multi-page item, formatted
+    # with its arcid, if they are listed there instead of on every page
+    page_index_title = None
+
+    metadata_fields = ('description', 'scope_and_content', 'general_notes',
+                       'local_id', 'creators', 'authors', 'places', 'contacts',
+                       'dates', 'record_group', 'series', 'file_unit',
+                       'variant_control_numbers')
+
     def __init__(self, arcid, *files):
         print("\nGenerating item for arcid #{0}".format(arcid))
         self.arcid = arcid
         self.files = files
+        self.metadata_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_cache = {}
         for n in range(len(self.files)):
             files[n].item = self
             files[n].index = n
         for i in self.pagination:
             print("Page {0}: {1}".format(i[0], i[1]))
-        jar = cookielib.CookieJar()
-        self.__opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(jar))
+        self.__jar = None
 
     def __getitem__(self, key):
         return self.files[key]
@@ -167,246 +1763,290 @@ class Item(object):
     def __repr__(self):
         return "Item({0}, {1})".format(self.arcid, self.files)
 
+    def invalidate(self, *names):
+        # drop the named cached properties (or all of them, including the
+        # item page metadata) so that they are fetched again on next access
+        if names:
+            for name in names:
+                self.metadata_cache.pop(name, None)
+        else:
+            self.metadata_cache.clear()
+        # everything rendered from the metadata has to be redone in any case
+        self.render_cache.clear()
+
+    @property
+    def __cookie_jar(self):
+        # each item has a catalog session of its own; the jar is made on
+        # first use, since most items are never scraped before the batch
+        # reaches them
+        if self.__jar is None:
+            self.__jar = cookielib.CookieJar()
+        return self.__jar
+
+    def __scrape(self, url, referer, extract, *args):
+        # the page at url, parsed with extract(body, *args); with a page
+        # cache, what is extracted is cached along with the page
+        parse = lambda body: self.__parse(extract, body, *args)
+        if self.page_cache:
+            return self.page_cache.fetch(
+                url, lambda headers: self.__open(url, referer, headers),
+                parse, extract.__name__)
+        return parse(self.__open(url, referer).read())
+
+    def __open(self, url, referer=None, headers={}):
+        if referer:
+            headers = dict(headers, Referer=referer)
+        if self.host_limiter:
+            with self.host_limiter.slot(url):
+                return self.transport.open(url, headers=headers,
+                                           jar=self.__cookie_jar)
+        return self.transport.open(url, headers=headers,
+                                   jar=self.__cookie_jar)
+
+    def __parse(self, extract, *args):
+        if self.parser_pool:
+            return self.parser_pool(extract, *args)
+        return extract(*args)
+
+    def prefetch(self):
+        # resolve all of the metadata used for the file descriptions; errors
+        # are left to surface again when the properties are used
+        for name in self.metadata_fields:
+            try:
+                getattr(self, name)
+            except Exception:
+                pass
+
     @property
     def __item_url(self):
         url = 'http://arcweb.archives.gov/arc/action/ExternalIdSearch?id=' + \
                str(self.arcid)
         return(url)
         
-    @property
-    def __item_page(self):
-        if not hasattr(self, '__item_page_cached'):
-            self.__item_page_cached = \
-                BeautifulSoup(self.__opener.open(self.__item_url).read())    
-        return self.__item_page_cached
-
-    @property
-    def __hierarchy_page(self):
-        if not hasattr(self, '__hierarchy_page_cached'):
-            hier_link = \
-                self.__item_page.find('a',
-                    href=re.compile('showFullDescriptionTabs/hierarchy'))
-            if hier_link:
-                hier_url = 'http://arcweb.archives.gov' + hier_link['href']
-                self.__opener.addheaders = [('Referer', self.__item_url)]
-                self.__hierarchy_page_cached = \
-                    BeautifulSoup(self.__opener.open(hier_url).read())
-            else:
-                self.__hierarchy_page_cached = None
-        return self.__hierarchy_page_cached
-    
-    @property
-    def pagination(self):
-        if not hasattr(self, '__pagination'):
+    @memoized_property
+    def metadata(self):
+        if self.metadata_backend:
+            return self.metadata_backend.metadata(self.arcid)
+        return self.__scrape(self.__item_url, None, extract_item_metadata,
+                             self.arcid)
+
+    @memoized_property
+    def hierarchy_key(self):
+        return self.metadata.hierarchy_key
+
+    @memoized_property
+    def __hierarchy(self):
+        # the record group, series and file unit of an item are those of
+        # every sibling with the same ancestors, so the hierarchy page is
+        # only fetched and parsed for the first of them
+        key = self.hierarchy_key
+        hierarchy = self.hierarchy_cache.get(key) if key else None
+        if hierarchy is None:
+            if not self.metadata.hierarchy_href:
+                return (self.metadata.record_group,
+                        self.metadata.series,
+                        self.metadata.file_unit)
             try:
-                self.__pagination = [(i+1, j) for i, j in enumerate(self.files)]
+                hier_url = 'http://arcweb.archives.gov' + \
+                           self.metadata.hierarchy_href
+                hierarchy = self.__scrape(hier_url, self.__item_url,
+                                          extract_hierarchy)
             except:
-                self.__pagination = None
-        return self.__pagination
+                return None, None, None
+            # only shared once the key is known to include the file unit
+            if key and hierarchy[2]:
+                self.hierarchy_cache.put(key, hierarchy)
+        return hierarchy
 
-    @property
+    @memoized_property
+    def pagination(self):
+        try:
+            return [(i+1, j) for i, j in enumerate(self.files)]
+        except:
+            return None
+
+    @memoized_property
     def authors(self):
-        if not hasattr(self, '__authors'):
-            try:
-                self.__authors = []
-                for a in self.__item_page.findAll('a',
-                        href=re.compile(r'^ExecuteRelatedPeopleSearch\?')):
-                    m = re.match(r'^ExecuteRelatedPeopleSearch\?id=(\d+)&',
-                                 a['href'])
-                    self.__authors.append(Author(int(m.group(1)), a.text))
-            except:
-                self.__authors = None
-        return self.__authors
+        return self.metadata.authors
 
-    @property
+    @memoized_property
     def contacts(self):
-        if not hasattr(self, '__contacts'):
-            try:
-                contacts = \
-                    soup_to_plaintext(self.__item_page
-                                      .find('p', 'contacts')).split('\n')
-                self.__contacts = []
-                for contact in contacts:
-                    contact = contact.strip()
-                    contact = re.sub(' PHONE:.*$', '', contact)
-                    if contact:
-                        self.__contacts.append(contact)
-            except:
-                self.__contacts = None
-        return self.__contacts        
+        return self.metadata.contacts
 
-    @property
+    @memoized_property
     def creators(self):
-        if not hasattr(self, '__creators'):
-            try:
-                creators = \
-                    soup_to_plaintext(self.__item_page.find(text='Creator(s):')
-                        .parent.next_sibling).split('\n')
-                self.__creators = []
-                for creator in creators:
-                    creator = creator.strip()
-                    if creator:
-                        self.__creators.append(creator)
-            except:
-                self.__creators = None
-        return self.__creators
+        return self.metadata.creators
 
-    @property
+    @memoized_property
     def dates(self):
-        if not hasattr(self, '__dates'):
-            date_field = self.__item_page.find(text='Production Date(s):') or \
-                         self.__item_page.find(text='Coverage Dates:') or \
-                         self.__item_page.find(text='Broadcast Date(s):') or \
-                         None
-            if date_field:
-                date_str = date_field.parent.parent.next_sibling.text.strip()
-                date_str = wikitext_escape(date_str)
-                date_str = re.sub(r'(?<![{=|])\b(\d+)/(\d+)/(\d+)',
-                                  r"\3-\1-\2",
-                                  date_str)
-                date_str = re.sub(r'(?<![{=|])\b(\d+)/(\d+)',
-                                  r"\2-\1",
-                                  date_str)
-                date_str = re.sub(r'(?<![{=|])\b(\d+)',
-                                  r"\1",
-                                  date_str)
-                self.__dates = date_str
-            else:
-                self.__dates = None
-        return self.__dates
+        return self.metadata.dates
 
-    @property
+    @memoized_property
     def description(self):
-        return list(self.__item_page.find('strong', 'sFC'))[0].strip()
+        if self.metadata.description is None:
+            raise ValueError("no title found for arcid #{0}"
+                             .format(self.arcid))
+        return self.metadata.description
 
-    @property
+    @memoized_property
     def file_unit(self):
-        if not hasattr(self, '__file_unit'):
-            try:
-                treel3 = self.__hierarchy_page.find('span', 'treel3')
-                name = treel3.find('span', 'hierRecord').text
-                id = treel3.find('span', 'hierlocalid').strong.text
-                self.__file_unit = FileUnit(id, name)
-            except:
-                self.__file_unit = None
-        return self.__file_unit
+        return self.__hierarchy[2]
 
-    @property
+    @memoized_property
     def general_notes(self):
-        if not hasattr(self, '__general_notes'):
-            try:
-                self.__general_notes = \
-                    self.__item_page.find(text='General Note(s):') \
-                    .parent.next_sibling.text.strip()
-            except:
-                self.__general_notes = None
-        return self.__general_notes
+        return self.metadata.general_notes
 
-    @property
+    @memoized_property
     def local_id(self):
-        if not hasattr(self, '__local_identifier'):
-            try:
-                arcid_field = self.__item_page.find('strong', 'arcID').text
-                m = re.match('ARC Identifier (.+) / Local Identifier (.+)',
-                             arcid_field)
-                self.__local_identifier = m.group(2)
-            except:
-                self.__local_identifier = None
-        return self.__local_identifier
+        return self.metadata.local_id
 
-    @property
+    @memoized_property
     def places(self):
-        if not hasattr(self, '__places'):
+        if self.metadata.places is not None:
+            return self.metadata.places
+        places = []
+        for id, name, href in self.metadata.place_links:
             try:
-                self.__places = []
-                for a in self.__item_page.findAll('a',
-                        href=re.compile(r'^ExecuteRelatedGeographical')):
-                    m = re.match(r'^ExecuteRelatedGeographicalSearch'
-                                 '\?id=(\d+)&',
-                                 a['href'])
-                    id = int(m.group(1))
-                    name = a.text
-                    latitude = None
-                    longitude = None
-                    try:
-                        place_url = ('http://arcweb.archives.gov/arc/action/'
-                                     + a['href'])
-                        self.__opener.addheaders = [('Referer',
-                                                     self.__item_url)]
-                        soup = BeautifulSoup(self.__opener.open(place_url)
-                                             .read(),
-                                             parse_only=
-                                             SoupStrainer('div', 'genPad'))
-                        coords = \
-                            soup.find(text="Coordinates:").parent \
-                            .next_sibling.text
-                        m = re.search('\((.+), (.+)\)', coords)
-                        latitude = m.group(1)
-                        longitude = m.group(2)
-                    except:
-                        pass
-                    self.__places.append(Place(id, name, latitude, longitude))
+                latitude, longitude = self.place_resolver.resolve(
+                    id, lambda: self.__place_coordinates(href))
             except:
-                self.__places = None
-        return self.__places
+                latitude = None
+                longitude = None
+            places.append(Place(id, name, latitude, longitude))
+        return places
 
-    @property
+    def __place_coordinates(self, href):
+        place_url = 'http://arcweb.archives.gov/arc/action/' + href
+        return self.__scrape(place_url, self.__item_url,
+                             extract_place_coordinates)
+
+    @memoized_property
     def record_group(self):
-        if not hasattr(self, '__record_group'):
-            try:
-                treel1 = self.__hierarchy_page.find('span', 'treel1')
-                name = treel1.span.strong.text.strip() + " " + \
-                       treel1.find('span', 'hierRecord').text.strip()
-                id = int(treel1.find('span', 'hierlocalid').strong.text)
-                self.__record_group = RecordGroup(id, name)
-            except:
-                self.__record_group = None
-        return self.__record_group
+        return self.__hierarchy[0]
 
-    @property
+    @memoized_property
     def scope_and_content(self):
-        if not hasattr(self, '__scope_and_content'):
-            scope_link = \
-                self.__item_page.find('a',
-                    href=re.compile('showFullDescriptionTabs/scope'))
-            if scope_link:
-                scope_url = 'http://arcweb.archives.gov' + scope_link['href']
-                self.__opener.addheaders = [('Referer', self.__item_url)]
-                soup = BeautifulSoup(self.__opener.open(scope_url).read(),
-                                     parse_only=SoupStrainer('div', 'genPad'))
-                self.__scope_and_content = soup.text.strip()
-            else:
-                self.__scope_and_content = None
-        return self.__scope_and_content
+        if self.metadata.scope_href:
+            scope_url = 'http://arcweb.archives.gov' + \
+                        self.metadata.scope_href
+            return self.__scrape(scope_url, self.__item_url,
+                                 extract_scope_and_content)
+        else:
+            return self.metadata.scope_and_content
 
-    @property
+    @memoized_property
     def series(self):
-        if not hasattr(self, '__series'):
-            try:
-                treel2 = self.__hierarchy_page.find('span', 'treel2')
-                name = treel2.find('span', 'hierRecord').text.strip()
-                id = int(treel2.find('span', 'hierlocalid').strong.text)
-                self.__series = Series(id, name)
-            except:
-                self.__series = None
-        return self.__series
+        return self.__hierarchy[1]
 
-    @property
+    @memoized_property
     def variant_control_numbers(self):
-        if not hasattr(self, '__variant_control_numbers'):
-            try:
-                vcns = \
-                    soup_to_plaintext(self.__item_page.find(
-                        text='Variant Control Number(s):')
-                        .parent.next_sibling).split('\n')
-                self.__variant_control_numbers = []
-                for vcn in vcns:
-                    vcn = vcn.strip()
-                    if vcn:
-                        self.__variant_control_numbers.append(vcn)
-            except:
-                self.__variant_control_numbers = None
-        return self.__variant_control_numbers
+        return self.metadata.variant_control_numbers
+
+    def rendered(self, key, render, *args):
+        # the parts of the files' titles and wikitext which are the same for
+        # every page (and each file's wikitext) are only rendered once
+        try:
+            return self.render_cache[key]
+        except KeyError:
+            value = self.render_cache[key] = render(*args)
+            return value
+
+    def title(self, suffix_length):
+        """The description, trimmed to leave room for a title suffix."""
+        return self.rendered(('title', suffix_length), self.__trim_title,
+                             suffix_length)
+
+    def __trim_title(self, suffix_length):
+        title = self.description
+        while len(title) + suffix_length > 120:
+            trimmed = re.sub('\s+\S+$', '', title)
+            if trimmed == title:
+                break
+            title = trimmed
+        if title == "" or len(title) + suffix_length > 120:
+            title = self.description[:120 - suffix_length]
+        title = re.sub(r'#|<|>|\[|\]|\||\{|\}|:|/', '-', title)
+        return re.sub('\s+', ' ', title)
+
+    @property
+    def page_titles(self):
+        return self.rendered('page_titles',
+                             lambda: [f.wiki_filename for f in self.files])
+
+    @property
+    def wikitext_fields(self):
+        return self.rendered('wikitext_fields', self.__wikitext_fields)
+
+    def __wikitext_fields(self):
+        escape = wikitext_escape
+
+        m = {}
+        m['title'] = escape(self.description)
+        m['scope_and_content'] = escape(self.scope_and_content or "")
+        m['general_notes'] = escape(self.general_notes or "")
+        m['arc'] = self.arcid
+        m['local_identifier'] = escape(self.local_id or "")
+        m['creator'] = "<br/>\n".join(map(escape, self.creators or []))
+        authors = []
+        for author in self.authors or []:
+            authors.append("{{{{NARA-Author|{0}|{1}}}}}"
+                           .format(escape(author.name), author.id))
+        m['author'] = "<br/>\n".join(authors)
+        places = []
+        for place in self.places or []:
+            if place.latitude and place.longitude:
+                places.append("{{{{NARA-Place|{0}|{1}|{2}|{3}}}}}"
+                              .format(escape(place.name),
+                                      place.id,
+                                      float(place.latitude),
+                                      float(place.longitude)))
+            else:
+                places.append("{{{{NARA-Place|{0}|{1}}}}}" \
+                              .format(escape(place.name),
+                                      place.id))
+        m['place'] = "<br/>\n".join(places)
+        m['location'] = "<br/>\n".join(map(escape, self.contacts or ""))
+        m['date'] = self.dates or ""
+        m['record_group_arc'], m['record_group'] = \
+            self.record_group or ("", "")
+        m['series_arc'], m['series'] = \
+            self.series or ("", "")
+        m['file_unit_arc'], m['file_unit'] = \
+            self.file_unit or ("", "")
+        m['variant_control_numbers'] = \
+            "\n*".join(map(escape, self.variant_control_numbers or []))
+        if self.page_index:
+            m['other_pages'] = u"{{{{:{0}}}}}".format(self.page_index.title)
+        else:
+            m['other_pages'] = self.__other_pages()
+        return m
+
+    @property
+    def page_index(self):
+        if not self.page_index_title or len(self.files) <= 1:
+            return None
+        return self.rendered('page_index', lambda: PageIndex(
+            self.arcid, self.page_index_title.format(arcid=self.arcid),
+            self.__other_pages()))
+
+    def __other_pages(self):
+        if len(self.files) <= 1:
+            return ""
+        tiflinks = []
+        jpglinks = []
+        for (pagenumber, filename) in enumerate(self.page_titles, 1):
+            if filename.endswith(".tif"):
+                tiflinks.append('File:{0}|page&#32;{1} (TIFF)\n'.format(
+                    filename, pagenumber))
+                jpglinks.append('File:{0}|page {1} (JPG)\n'.format(
+                    (filename[:-4] + ".jpg"), pagenumber))
+            else:
+                jpglinks.append('File:{0}|page {1} (JPG)\n'.format(
+                    filename, pagenumber))
+        # unicode, like the template, so that it is not decoded again for
+        # every page
+        return u"<gallery>\n{0}</gallery>\n<br/>\n----\n<br/>\n<gallery>\n{1}</gallery>".format(
+            u"".join(tiflinks), u"".join(jpglinks))
 
 #
 #  end of the ITEM class
@@ -415,13 +2055,15 @@ class Item(object):
 #
 
 class File(object):
-    def __init__(self, filename):
+    def __init__(self, filename, size=None):
         self.filename = filename
         self.item = None
         self.index = None
+        self.__size = size
+        self.__sha1 = None
 
     @staticmethod
-    def from_extension(self, filename):
+    def from_extension(self, filename, size=None):
         known_exts = {'.jpg':  JPEGFile,
                       '.jpeg': JPEGFile,
                       '.tif':  TIFFFile,
@@ -430,7 +2072,7 @@ class File(object):
                       '.oga':  VorbisFile,
                       '.ogv':  TheoraFile}
         ext = os.path.splitext(filename)[1].lower()
-        return known_exts[ext](filename)
+        return known_exts[ext](filename, size)
 
     @property
     def canonical_extension(self):
@@ -438,26 +2080,65 @@ class File(object):
 
     @property
     def all_pages(self):
-        return [(p+1, f.wiki_filename) for p, f in enumerate(self.item.files)]
+        return list(enumerate(self.item.page_titles, 1))
 
     @property
     def size(self):
-        return os.path.getsize(self.filename)
+        if self.__size is None:
+            self.__size = os.path.getsize(self.filename)
+        return self.__size
 
-    def to_jpeg(self):
+    @property
+    def needs_jpeg(self):
+        # whether a JPEG version is converted and uploaded alongside this file
+        return isinstance(self, ImageFile) and not isinstance(self, JPEGFile)
+
+    @property
+    def jpeg_filename(self):
         new_basename_root, old_ext = \
             os.path.splitext(os.path.basename(self.filename))
         new_basename = new_basename_root + '.jpg'
-        new_filename = tempfile.gettempdir() + os.path.sep + new_basename
+        return tempfile.gettempdir() + os.path.sep + new_basename
+
+    @property
+    def sha1(self):
+        if self.__sha1 is None:
+            sha1 = hashlib.sha1()
+            f = open(self.filename, 'rb')
+            while True:
+                block = f.read(512)
+                if not block:
+                    break
+                sha1.update(block)
+            f.close()
+            self.__sha1 = sha1.hexdigest()
+        return self.__sha1
+
+    def jpeg_file(self, filename=None):
+        # the JPEG version of this file, without converting it yet
+        new_file = JPEGFile(filename or self.jpeg_filename)
+        new_file.item = self.item
+        new_file.index = self.index
+        return new_file
 
+    def save_jpeg(self, new_filename):
         image = Image.open(self.filename)
         if image.mode != 'RGB':
             image = image.convert('RGB')
         image.save(new_filename, 'JPEG', quality=100)
-        new_file = JPEGFile(new_filename)
-        new_file.item = self.item
-        new_file.index = self.index
-        return new_file
+
+    def to_jpeg(self):
+        # converted into a temporary file of its own, as pages in different
+        # folders (and so different uploads at once) can share a basename
+        fd, filename = tempfile.mkstemp(
+            suffix='-' + os.path.basename(self.jpeg_filename))
+        os.close(fd)
+        try:
+            self.save_jpeg(filename)
+        except:
+            os.remove(filename)
+            raise
+        return self.jpeg_file(filename)
 
     @property
     def wiki_filename(self):
@@ -470,86 +2151,50 @@ class File(object):
                              len(self.item.files),
                              self.item.arcid,
                              self.canonical_extension)
-        title = self.item.description
-        while len(title + suffix) > 120:
-            title = re.sub('\s+\S+$', '', title)
-        if title == "":
-            title = self.item.description[:120 - len(suffix)]
-        title = re.sub(r'#|<|>|\[|\]|\||\{|\}|:|/', '-', title)
-        title = re.sub('\s+', ' ', title)
-        return title + suffix
+        return self.item.title(len(suffix)) + suffix
 
     @property
     def os_filename(self):
         return re.sub(r'<|>|:|"|/|\\|\||\?|\*', '-', self.wiki_filename)
 
+    wikitext_template = WikitextTemplate(
+        u"== {{{{int:filedesc}}}} ==\n"
+        u"{{{{NARA-image-full\n"
+        u"|Title={title}\n"
+        u"|Scope and content={scope_and_content}\n"
+        u"|General notes={general_notes}\n"
+        u"|ARC={arc}\n"
+        u"|Local identifier={local_identifier}\n"
+        u"|Creator={creator}\n"
+        u"|Author={author}\n"
+        u"|Place={place}\n"
+        u"|Location={location}\n"
+        u"|Date={date}\n"
+        u"|Record group={record_group}\n"
+        u"|Record group ARC={record_group_arc}\n"
+        u"|Series={series}\n"
+        u"|Series ARC={series_arc}\n"
+        u"|File unit={file_unit}\n"
+        u"|File unit ARC={file_unit_arc}\n"
+        u"|Variant control numbers={variant_control_numbers}\n"
+        u"|TIFF={tiff}\n"
+        u"|Other versions={other_versions}\n"
+        u"|Other pages={other_pages}\n"
+        u"}}}}\n\n"
+        u"== {{{{int:license-header}}}} ==\n"
+        u"{{{{NARA-cooperation}}}}\n"
+        u"{{{{PD-USGov}}}}\n\n"
+        u"{{{{Uncategorized-NARA|year={{{{subst:CURRENTYEAR}}}}|month={{{{subst:CURRENTMONTHNAME}}}}|day={{{{subst:CURRENTDAY}}}}}}}}")
+
     @property
     def wikitext(self):
-        text  = u"== {{{{int:filedesc}}}} ==\n"
-        text += u"{{{{NARA-image-full\n"
-        text += u"|Title={title}\n"
-        text += u"|Scope and content={scope_and_content}\n"
-        text += u"|General notes={general_notes}\n"
-        text += u"|ARC={arc}\n"
-        text += u"|Local identifier={local_identifier}\n"
-        text += u"|Creator={creator}\n"
-        text += u"|Author={author}\n"
-        text += u"|Place={place}\n"
-        text += u"|Location={location}\n"
-        text += u"|Date={date}\n"
-        text += u"|Record group={record_group}\n"
-        text += u"|Record group ARC={record_group_arc}\n"
-        text += u"|Series={series}\n"
-        text += u"|Series ARC={series_arc}\n"
-        text += u"|File unit={file_unit}\n"
-        text += u"|File unit ARC={file_unit_arc}\n"
-        text += u"|Variant control numbers={variant_control_numbers}\n"
-        text += u"|TIFF={tiff}\n"
-        text += u"|Other versions={other_versions}\n"
-        text += u"|Other pages={other_pages}\n"
-        text += u"}}}}\n\n"
-        text += u"== {{{{int:license-header}}}} ==\n"
-        text += u"{{{{NARA-cooperation}}}}\n"
-        text += u"{{{{PD-USGov}}}}\n\n"
-        text += u"{{{{Uncategorized-NARA|year={{{{subst:CURRENTYEAR}}}}|month={{{{subst:CURRENTMONTHNAME}}}}|day={{{{subst:CURRENTDAY}}}}}}}}"
-
-        escape = wikitext_escape
+        # rendered once for each page and format, and kept by the item
+        return self.item.rendered(('wikitext', self.index,
+                                   self.canonical_extension),
+                                  self.render_wikitext)
 
-        m = {}
-        m['title'] = escape(self.item.description)
-        m['scope_and_content'] = escape(self.item.scope_and_content or "")
-        m['general_notes'] = escape(self.item.general_notes or "")
-        m['arc'] = self.item.arcid
-        m['local_identifier'] = escape(self.item.local_id or "")
-        m['creator'] = "<br/>\n".join(map(escape, self.item.creators or []))
-        authors = []
-        for author in self.item.authors or []:
-            authors.append("{{{{NARA-Author|{0}|{1}}}}}"
-                           .format(escape(author.name), author.id))
-        m['author'] = "<br/>\n".join(authors)
-        places = []
-        for place in self.item.places or []:
-            if place.latitude and place.longitude:
-                places.append("{{{{NARA-Place|{0}|{1}|{2}|{3}}}}}"
-                              .format(escape(place.name),
-                                      place.id,
-                                      float(place.latitude),
-                                      float(place.longitude)))
-            else:
-                places.append("{{{{NARA-Place|{0}|{1}}}}}" \
-                              .format(escape(place.name),
-                                      place.id))
-        m['place'] = "<br/>\n".join(places)
-        m['location'] = "<br/>\n".join(map(escape, self.item.contacts or ""))
-        m['date'] = self.item.dates or ""
-        m['record_group_arc'], m['record_group'] = \
-            self.item.record_group or ("", "")
-        m['series_arc'], m['series'] = \
-            self.item.series or ("", "")
-        m['file_unit_arc'], m['file_unit'] = \
-            self.item.file_unit or ("", "")
-        m['variant_control_numbers'] = \
-            "\n*".join(map(escape, self.item.variant_control_numbers or []))
+    def render_wikitext(self):
+        m = dict(self.item.wikitext_fields)
         m['tiff'] = "yes" if isinstance(self, TIFFFile) else ""
         m['other_versions'] = ""
         if isinstance(self, TIFFFile):
@@ -557,23 +2202,7 @@ class File(object):
                 "<gallery>\nFile:{0}|This page as TIFF\nFile:{1}|This page as JPG\n</gallery>".format(
                     self.wiki_filename,
                     self.wiki_filename[:-4] + ".jpg")
-        if len(self.all_pages) > 1:
-            tiflinks = ""
-            jpglinks = ""
-            for (pagenumber, filename) in self.all_pages:
-                if filename.endswith(".tif"):
-                    tiflinks += 'File:{0}|page&#32;{1} (TIFF)\n'.format(
-                        filename, pagenumber)
-                    jpglinks += 'File:{0}|page {1} (JPG)\n'.format(
-                        (filename[:-4] + ".jpg"), pagenumber)
-                else:
-                    jpglinks += 'File:{0}|page {1} (JPG)\n'.format(
-                        filename, pagenumber)
-            m['other_pages'] = "<gallery>\n{0}</gallery>\n<br/>\n----\n<br/>\n<gallery>\n{1}</gallery>".format(
-                tiflinks, jpglinks)
-        else:
-            m['other_pages'] = ""
-        return text.format(**m)
+        return self.wikitext_template.render(m)
 
 #
 # End of the FILE class
@@ -622,10 +2251,354 @@ class TheoraFile(VideoFile):
 #
 #  end the class definitions for various file types
 ###############################################################################
+#  begin the UPLOAD PLAN definitions
+#
+
+class PlannedFile(File):
+    """A file whose title, hash and wikitext were worked out by write_plan."""
+
+    def __init__(self, plan):
+        File.__init__(self, plan['filename'], plan['size'])
+        self.plan = plan
+
+    @property
+    def needs_jpeg(self):
+        return self.plan['jpeg'] is not None
+
+    @property
+    def jpeg_filename(self):
+        return self.plan['jpeg']['filename']
+
+    @property
+    def sha1(self):
+        return self.plan['sha1'] or File.sha1.fget(self)
+
+    @property
+    def wiki_filename(self):
+        return self.plan['wiki_filename']
+
+    @property
+    def os_filename(self):
+        return self.plan['os_filename']
+
+    @property
+    def wikitext(self):
+        return self.plan['wikitext']
+
+    def jpeg_file(self, filename=None):
+        if filename:
+            return PlannedFile(dict(self.plan['jpeg'], filename=filename))
+        return PlannedFile(self.plan['jpeg'])
+
+
+def file_plan(file, sha1=True):
+    plan = {'filename': file.filename,
+            'size': None,
+            'sha1': None,
+            'wiki_filename': file.wiki_filename,
+            'os_filename': file.os_filename,
+            'wikitext': file.wikitext,
+            'jpeg': None}
+    # the hash of a converted JPEG is only known once it has been converted
+    if sha1:
+        plan['size'] = file.size
+        plan['sha1'] = file.sha1
+    if file.needs_jpeg:
+        plan['jpeg'] = file_plan(file.jpeg_file(), sha1=False)
+    return plan
+
+
+def write_plan(batch, plan_filename, prefetch=0):
+    print("\nWriting the upload plan \"{0}\" ...".format(plan_filename))
+    start = time.time()
+    count = 0
+    items = batch
+    if prefetch:
+        items = MetadataPrefetcher(batch, prefetch)
+    with open(plan_filename, 'w') as f:
+        for item in items:
+            if item.page_index:
+                print(json.dumps({'page_index': item.page_index._asdict()}),
+                      file=f)
+            for file in item.files:
+                print(json.dumps(file_plan(file)), file=f)
+                count += 1
+    elapsed = time.time() - start
+    print("Planned {0} files in {1:.2f}s ({2:.1f} files/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0))
+
+
+def read_plan(plan_filename):
+    for line in open(plan_filename):
+        if line.strip():
+            plan = json.loads(line)
+            if 'page_index' in plan:
+                yield PageIndex(**plan['page_index'])
+            else:
+                yield PlannedFile(plan)
+
+#
+#  end of the UPLOAD PLAN definitions
+###############################################################################
+#  begin the UPLOAD POOL class definitions
+#
+
+class ByteBudget(object):
+    """Bounds the total size of the files being uploaded at once."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.__condition:
+            # a file bigger than the whole budget is let through on its own
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.__condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.__condition:
+            self.in_flight -= size
+            self.__condition.notify_all()
+
+
+class UploadPool(object):
+    """Uploads files on a number of worker threads.
+
+    upload is called with each file submitted, on one of the workers; the
+    files being uploaded at any one time add up to at most max_in_flight
+    bytes.  After the first upload which fails, the files still waiting are
+    dropped and the error is raised again by join().
+    """
+
+    def __init__(self, upload, workers, max_in_flight=None):
+        self.upload = upload
+        self.budget = ByteBudget(max_in_flight) if max_in_flight else None
+        self.error = None
+        self.stats = [collections.Counter() for n in range(workers)]
+        self.__tasks = Queue.Queue(workers)
+        self.__workers = []
+        for n in range(workers):
+            worker = threading.Thread(target=self.__work, args=(n,))
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+        self.__start = time.time()
+
+    def submit(self, file):
+        if self.error:
+            self.join()
+        size = file.size
+        if self.budget:
+            self.budget.acquire(size)
+        self.__tasks.put((file, size))
+
+    def __work(self, n):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                break
+            file, size = task
+            try:
+                if self.error is None:
+                    start = time.time()
+                    self.upload(file)
+                    self.stats[n].update(files=1, bytes=size,
+                                         seconds=time.time() - start)
+            except Exception:
+                self.error = self.error or sys.exc_info()
+                print("uploading '{0}' failed: {1}".format(
+                    file.filename, self.error[1]), file=sys.stderr)
+            finally:
+                if self.budget:
+                    self.budget.release(size)
+
+    def join(self):
+        # waits for the files submitted to be uploaded (or dropped)
+        for worker in self.__workers:
+            self.__tasks.put(None)
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+        self.report()
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def report(self):
+        elapsed = time.time() - self.__start
+        total = collections.Counter()
+        print()
+        for n, stats in enumerate(self.stats):
+            total.update(stats)
+            print("Upload worker {0}: {1} files, {2:.1f} MB in {3:.1f}s "
+                  "({4:.2f} MB/s)".format(
+                      n + 1, stats['files'], stats['bytes'] / 1048576.0,
+                      stats['seconds'],
+                      stats['bytes'] / 1048576.0 / stats['seconds']
+                      if stats['seconds'] else 0))
+        print("Uploaded {0} files, {1:.1f} MB in {2:.1f}s ({3:.2f} MB/s) "
+              "with {4} workers".format(
+                  total['files'], total['bytes'] / 1048576.0, elapsed,
+                  total['bytes'] / 1048576.0 / elapsed if elapsed else 0,
+                  len(self.stats)))
+
+#
+#  end of the UPLOAD POOL class definitions
+###############################################################################
+#  begin the RATE CONTROL class definitions
+#
+
+class Throttled(Exception):
+    """The API asked for a request to be sent again later."""
+
+    def __init__(self, reason, wait):
+        Exception.__init__(self, reason)
+        self.wait = wait
+
+
+def retry_after(headers, default):
+    # the seconds to wait from a Retry-After header (an HTTP date is ignored)
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+
+class RateController(object):
+    """Fits the bot's requests in flight, and their rate, to the server.
+
+    The window of requests let in at once grows by one per round trip of
+    prompt replies and is halved whenever the server turns a request away (a
+    429 or 503, or a maxlag error), when the interval between requests is
+    doubled and nothing is sent until the server's Retry-After has passed;
+    prompt replies shorten the interval again.  The window changes at most
+    once per round trip, judged on a window's worth of replies to requests
+    sent since it last changed.
+
+    Replies slower on average than the quickest one seen are taken to have
+    queued at the server: the window stops growing once about one request is
+    queued, and shrinks by one beyond two, so that it settles below the point
+    where the server starts turning requests away.
+
+    acquire() returns a ticket, to be handed back to success(), throttle()
+    or failure() once the reply is in.
+    """
+
+    min_interval = 0.05
+    max_interval = 60.0
+
+    def __init__(self, max_window=1, window=1.0):
+        self.max_window = max_window
+        self.window = min(window, max_window)
+        self.interval = 0.0
+        self.active = 0
+        self.resume = 0.0
+        self.sent = 0
+        self.changed = 0
+        self.min_latency = None
+        self.latencies = []
+        self.stats = collections.Counter()
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while True:
+                now = time.time()
+                if now < self.resume:
+                    self.__condition.wait(self.resume - now)
+                elif self.active >= int(self.window):
+                    self.__condition.wait()
+                else:
+                    break
+            self.active += 1
+            self.resume = now + self.interval
+            self.sent += 1
+            self.stats['requests'] += 1
+            self.stats['peak'] = max(self.stats['peak'], self.active)
+            return self.sent
+
+    def success(self, ticket, latency):
+        with self.__condition:
+            self.active -= 1
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            if latency <= 2 * self.min_latency:
+                self.interval *= 0.5
+                if self.interval < self.min_interval:
+                    self.interval = 0.0
+            if ticket > self.changed:
+                self.latencies.append(latency)
+            if len(self.latencies) >= int(self.window):
+                average = sum(self.latencies) / len(self.latencies)
+                queued = self.window * (1 - self.min_latency / average) \
+                    if average else 0.0
+                if queued < 1:
+                    self.window = min(self.max_window, self.window + 1)
+                elif queued > 2:
+                    self.window = max(1.0, self.window - 1)
+                self.changed = self.sent
+                self.latencies = []
+            self.__condition.notify_all()
+
+    def throttle(self, ticket, wait):
+        with self.__condition:
+            self.active -= 1
+            self.stats['throttled'] += 1
+            if ticket > self.changed:
+                self.changed = self.sent
+                self.latencies = []
+                self.window = max(1.0, self.window / 2)
+                self.interval = min(self.max_interval,
+                                    max(self.min_interval, self.interval * 2))
+            self.resume = max(self.resume, time.time() + wait)
+            self.__condition.notify_all()
+
+    def failure(self, ticket):
+        with self.__condition:
+            self.active -= 1
+            self.__condition.notify_all()
+
+    def report(self):
+        print("API requests: {0} sent, {1} throttled, at most {2} at once "
+              "(window now {3:.1f}, interval {4:.0f} ms)".format(
+                  self.stats['requests'], self.stats['throttled'],
+                  self.stats['peak'], self.window, self.interval * 1000))
+
+#
+#  end of the RATE CONTROL class definitions
+###############################################################################
 #  begin the UPLOAD BOT class definiton
 #
 
+class ApiError(Exception):
+    """An error reply from the API, with its error code."""
+
+    def __init__(self, code, info):
+        Exception.__init__(self, info)
+        self.code = code
+
+
+class BadToken(ApiError):
+    """The API rejected a token (it expired, or the session changed)."""
+
+
+def api_error(error):
+    # the exception for an error reply from the API
+    if error.get('code') == 'badtoken':
+        return BadToken(error['code'], error['info'])
+    return ApiError(error.get('code'), error['info'])
+
+
 class UploadBot(object):
+    max_retries = 10
+    default_wait = 5.0
+    # the errors with which the stash says it no longer has a file key
+    stash_errors = ('stashfailed', 'stashnosuchfilekey', 'stashfilenotfound',
+                    'stashwrongowner', 'invalid-file-key')
+
     def __init__(self,
                  api_url,
                  username,
@@ -634,12 +2607,22 @@ class UploadBot(object):
                  max_size=None,
                  overflow_dir=None,
                  state_filename=None,
-                 unknowns_filename=None):
+                 unknowns_filename=None,
+                 prefetch=0,
+                 transport=None,
+                 chunk_size=None,
+                 upload_workers=1,
+                 max_in_flight=None,
+                 maxlag=5):
         self.api_url = api_url
         self.jar = cookielib.CookieJar()
-        self.opener = \
-            urllib2.build_opener(urllib2.HTTPCookieProcessor(self.jar))
-        self.opener.addheaders = [('User-Agent', "narabot.py")]
+        self.transport = transport or Item.transport
+        self.maxlag = maxlag
+        self.rate = RateController(max_window=upload_workers)
+        self.tokens = {}
+        self.token_stats = collections.Counter()
+        self.tokens_rejected = 0
+        self.__tokens_lock = threading.Lock()
         
         print("Creating a test bot ...\n")
         print("Logging in as [[User:{0}]] ... ".format(username),
@@ -660,9 +2643,11 @@ class UploadBot(object):
         self.index_filename = index_filename
         self.max_size = max_size
         self.overflow_dir = overflow_dir
+        self.chunk_size = chunk_size
         self.skip_filenames = {}
         
         self.unknowns_filename = unknowns_filename
+        self.prefetch = prefetch
         if state_filename:
             try:
                 for filename in open(state_filename).readlines():
@@ -670,6 +2655,21 @@ class UploadBot(object):
             except:
                 open(state_filename, 'w').close()
         self.state_filename = state_filename
+        self.__state_lock = threading.Lock()
+        self.upload_workers = upload_workers
+        self.max_in_flight = max_in_flight
+        self.upload_pool = None
+
+        # the stash file keys and offsets of chunked uploads not finished yet
+        self.chunks = {}
+        self.chunks_filename = None
+        self.__chunks_lock = threading.Lock()
+        if state_filename:
+            self.chunks_filename = state_filename + '.chunks'
+            try:
+                self.chunks = json.load(open(self.chunks_filename))
+            except (IOError, ValueError):
+                pass
 
 
     def api_request(self, **post_data):
@@ -679,16 +2679,106 @@ class UploadBot(object):
                 post_data[new_key] = value
                 del post_data[key]
         post_data['format'] = 'json'
-        response = self.opener.open(self.api_url, urllib.urlencode(post_data))
+        if self.maxlag is not None:
+            post_data['maxlag'] = self.maxlag
+        response = self.api_send(urllib.urlencode(post_data))
         response_decoded = json.load(response)
         if not post_data['action'] in response_decoded:
-            raise Exception(response_decoded['error']['info'])
+            raise api_error(response_decoded['error'])
         return response_decoded[post_data['action']]
 
+
+    def token(self, kind):
+        # edit and move tokens last the whole session, so each is fetched
+        # once (and again only after the server rejects it)
+        with self.__tokens_lock:
+            if kind not in self.tokens:
+                reply = self.api_request(action='query',
+                                         prop='info',
+                                         titles='Main Page',
+                                         intoken=kind)
+                self.tokens[kind] = \
+                    reply['pages'].values()[0][kind + 'token']
+                self.token_stats[kind] += 1
+            return self.tokens[kind]
+
+
+    def with_token(self, kind, request):
+        """Call request with a token of the kind given and return its reply.
+
+        If the server rejects the token, it is fetched again and request is
+        called once more with the new one.
+        """
+        token = self.token(kind)
+        try:
+            return request(token)
+        except BadToken:
+            with self.__tokens_lock:
+                if self.tokens.get(kind) == token:
+                    del self.tokens[kind]
+                    self.tokens_rejected += 1
+            return request(self.token(kind))
+
+
+    def send_form(self, form):
+        if self.maxlag is not None:
+            form.add_field('maxlag', str(self.maxlag))
+        return self.api_send(form,
+                             headers={'Content-type': form.get_content_type(),
+                                      'Content-length': len(form)})
+
+
+    def api_send(self, data, headers=None):
+        """Send a request to the API under the rate controller.
+
+        A request turned away because the servers are lagged or overloaded
+        is sent again once they say they are ready for it, up to max_retries
+        times.
+        """
+        for attempt in range(self.max_retries + 1):
+            ticket = self.rate.acquire()
+            start = time.time()
+            try:
+                try:
+                    response = self.transport.open(self.api_url, data,
+                                                   headers=headers,
+                                                   jar=self.jar)
+                except urllib2.HTTPError as e:
+                    if e.code not in (429, 503):
+                        raise
+                    raise Throttled("HTTP error {0} {1}".format(e.code,
+                                                                e.msg),
+                                    retry_after(e.info(), self.default_wait))
+                if response.info().get('MediaWiki-API-Error') == 'maxlag':
+                    raise Throttled("servers lagged by {0}s".format(
+                                        response.info().get('X-Database-Lag',
+                                                            '?')),
+                                    retry_after(response.info(),
+                                                self.default_wait))
+            except Throttled as e:
+                self.rate.throttle(ticket, e.wait)
+                print("{0}; waiting {1:.1f}s".format(e, e.wait),
+                      file=sys.stderr)
+                if hasattr(data, 'seek'):
+                    data.seek(0)
+                continue
+            except:
+                self.rate.failure(ticket)
+                raise
+            self.rate.success(ticket, time.time() - start)
+            return response
+        raise Exception("the API turned a request away {0} times".format(
+            self.max_retries + 1))
+
     
-    def upload_directory(self, *directories):
+    def upload_directory(self, *directories, **options):
         print("Preparing the upload batch ... ")
-        self.upload_batch(Batch(self.index_filename, *directories))
+        snapshot_filename = None
+        if options.get('incremental') and self.state_filename:
+            snapshot_filename = self.state_filename + '.snapshot'
+        self.upload_batch(Batch(self.index_filename, *directories,
+                                snapshot_filename=snapshot_filename,
+                                order=options.get('order', 'arcid')))
 
 
     def upload_batch(self, batch):
@@ -699,23 +2789,107 @@ class UploadBot(object):
         for filename in batch.unknown_filenames:
             print("skipping unknown file '{0}'".format(filename),
                   file=sys.stderr)
-        for item in batch:
+        # modified files are uploaded again even if the state file records
+        # an earlier version of them as done; without a snapshot to compare
+        # against (a first incremental run, or a rerun after a crash), the
+        # state file is trusted
+        for filename in batch.modified_filenames:
+            self.skip_filenames.pop(filename, None)
+        items = batch
+        if self.prefetch:
+            items = MetadataPrefetcher(batch, self.prefetch)
+        for item in items:
             self.upload_item(item)
+        self.wait_for_uploads()
+        batch.save_snapshot()
 
 
     def upload_item(self, item):
-        for file in item.files:
+        # the pages are listed before they are uploaded, so that their
+        # descriptions never point to a missing page; an item whose pages
+        # were all uploaded already has its list written already
+        if item.page_index and any(file.filename not in self.skip_filenames
+                                   for file in item.files):
+            self.write_page_index(item.page_index)
+        self.upload_files(item.files)
+
+
+    def upload_files(self, files):
+        for file in files:
             if file.filename in self.skip_filenames:
                 print("file '{0}' was already uploaded"
                       .format(file.filename),
                       file=sys.stderr)
+            elif self.upload_workers > 1:
+                if self.upload_pool is None:
+                    self.upload_pool = UploadPool(self.upload_and_record,
+                                                  self.upload_workers,
+                                                  self.max_in_flight)
+                self.render(file)
+                self.upload_pool.submit(file)
             else:
-                self.upload_file(file)
+                self.upload_and_record(file)
+
+
+    def render(self, file):
+        # items have no locks, so the metadata and descriptions an upload
+        # needs are resolved here, before the workers share the item; errors
+        # are left to surface again in the worker
+        files = [file, file.jpeg_file()] if file.needs_jpeg else [file]
+        try:
+            for f in files:
+                f.wiki_filename, f.wikitext
+        except Exception:
+            pass
+
+
+    def upload_and_record(self, file):
+        # a file is only recorded in the state file once it is uploaded
+        self.upload_file(file)
+        if self.state_filename:
+            with self.__state_lock:
+                f = open(self.state_filename, 'a')
+                print(file.filename, file=f)
+                f.close()
+
+
+    def wait_for_uploads(self):
+        if self.upload_pool:
+            pool, self.upload_pool = self.upload_pool, None
+            pool.join()
+
+
+    def execute_plan(self, plan_filename):
+        print("Executing the upload plan \"{0}\" ... ".format(plan_filename))
+        # a page index is planned before the pages it lists, and only
+        # written once one of them is to be uploaded
+        page_index = None
+        for entry in read_plan(plan_filename):
+            if isinstance(entry, PageIndex):
+                page_index = entry
+            else:
+                if page_index and entry.filename not in self.skip_filenames:
+                    self.write_page_index(page_index)
+                    page_index = None
+                self.upload_files([entry])
+        self.wait_for_uploads()
 
-                if self.state_filename:
-                    f = open(self.state_filename, 'a')
-                    print(file.filename, file=f)
-                    f.close()
+
+    def write_page_index(self, page_index):
+        print("writing the pages of arcid #{0} to [[{1}]]... "
+              .format(page_index.arcid, page_index.title),
+              end='',
+              file=sys.stderr)
+        sys.stderr.flush()
+
+        title = page_index.title.encode('utf-8')
+        self.with_token('edit', lambda edit_token: self.api_request(
+            action='edit',
+            title=title,
+            text=page_index.text.encode('utf-8'),
+            summary="Pages of NARA item {0}".format(page_index.arcid),
+            token=edit_token))
+        print("success!", file=sys.stderr)
 
 
     def upload_file(self, file):
@@ -739,7 +2913,10 @@ class UploadBot(object):
         else:
             print("none!", file=sys.stderr)
             
-            if self.max_size and file.size > self.max_size:
+            # files too big to upload in one go are uploaded in chunks if
+            # they can be, or else set aside
+            if self.max_size and file.size > self.max_size and \
+                    not self.chunk_size:
                 if self.overflow_dir:
                     self.upload_big_file(file)
                 else:
@@ -753,63 +2930,149 @@ class UploadBot(object):
                       file=sys.stderr)
                 sys.stderr.flush()
 
-                reply = self.api_request(action='query',
-                                         prop='info',
-                                         titles=duplicate_name,
-                                         intoken='edit')
-                edit_token = reply['pages'].values()[0]['edittoken']
-
-                form = MultiPartForm()
-                form.add_field('action', 'upload')
-                form.add_field('filename', wiki_filename)
-                form.add_field('comment', file.wikitext)
-                form.add_field('text', file.wikitext)
-                form.add_field('token', edit_token)
-                form.add_field('ignorewarnings', 'true')
-                form.add_file('file', file.os_filename, 
-                              open(file.filename, 'rb'))
-
-                request = urllib2.Request(self.api_url)
-                body = str(form)
-                request.add_header('Content-type', form.get_content_type())
-                request.add_header('Content-length', len(body))
-                request.add_data(body)
-                response = self.opener.open(request)
-
-                error = re.findall('(?m)^MediaWiki-API-Error: (.*)$',
-                                   str(response.info()))
-                if error:
-                    raise Exception(error[0])
-                    print("failed.", file=sys.stderr)
+                if self.chunk_size and (
+                        file.size > self.chunk_size or
+                        self.max_size and file.size > self.max_size):
+                    self.upload_chunks(file, wiki_filename)
                 else:
-                    print("success!", file=sys.stderr)
+                    self.with_token('edit', lambda edit_token:
+                                    self.upload_form(file, wiki_filename,
+                                                     edit_token))
+                print("success!", file=sys.stderr)
         
-        if isinstance(file, ImageFile) and not isinstance(file, JPEGFile):
-            new_basename_root, old_ext = \
-                os.path.splitext(os.path.basename(file.filename))
-            new_basename = new_basename_root + '.jpg'
-            new_filename = tempfile.gettempdir() + os.path.sep + new_basename
-            print("converting '{0}' to '{1}'".format(file.filename,
-                                                     new_filename),
-                  file=sys.stderr)
+        if file.needs_jpeg:
             jpeg = file.to_jpeg()
-            self.upload_file(jpeg)
-            print("deleting '{0}'".format(new_filename),
+            print("converted '{0}' to '{1}'".format(file.filename,
+                                                    jpeg.filename),
                   file=sys.stderr)
-            os.remove(jpeg.filename)
+            try:
+                self.upload_file(jpeg)
+            finally:
+                print("deleting '{0}'".format(jpeg.filename),
+                      file=sys.stderr)
+                os.remove(jpeg.filename)
     
     
+    def upload_form(self, file, wiki_filename, edit_token):
+        form = MultiPartForm()
+        form.add_field('action', 'upload')
+        form.add_field('filename', wiki_filename)
+        form.add_field('comment', file.wikitext)
+        form.add_field('text', file.wikitext)
+        form.add_field('token', edit_token)
+        form.add_field('ignorewarnings', 'true')
+        with open(file.filename, 'rb') as f:
+            form.add_file('file', file.os_filename, f)
+            response = self.send_form(form)
+
+        error = re.findall('(?m)^MediaWiki-API-Error: (.*)$',
+                           str(response.info()))
+        if error:
+            print("failed.", file=sys.stderr)
+            raise api_error({'code': error[0], 'info': error[0]})
+
+
+    def post_form(self, form):
+        # a form posted to the API, with its reply decoded as api_request's
+        form.add_field('format', 'json')
+        response = self.send_form(form)
+        response_decoded = json.load(response)
+        if 'error' in response_decoded:
+            raise api_error(response_decoded['error'])
+        return response_decoded['upload']
+
+
+    def upload_chunks(self, file, wiki_filename):
+        """Upload a file to the stash chunk by chunk, then publish it.
+
+        The file key and offset are saved after every chunk, so that an
+        upload which is interrupted carries on from the last chunk stored
+        (as long as the file has not changed and the stash still has it).
+        """
+        stat = os.stat(file.filename)
+        size = stat.st_size
+        # no request is to be larger than --max-size either
+        chunk_size = min(self.chunk_size, self.max_size or self.chunk_size)
+        with self.__chunks_lock:
+            done = self.chunks.get(file.filename)
+        if done and [done['size'], done['mtime']] == [size, stat.st_mtime]:
+            filekey, offset = done['filekey'], done['offset']
+            print("resuming at {0} of {1} bytes... ".format(offset, size),
+                  end='', file=sys.stderr)
+        else:
+            filekey, offset = None, 0
+
+        def post_chunk(edit_token):
+            form = MultiPartForm()
+            form.add_field('action', 'upload')
+            form.add_field('stash', '1')
+            form.add_field('filename', wiki_filename)
+            form.add_field('filesize', str(size))
+            form.add_field('offset', str(offset))
+            form.add_field('token', edit_token)
+            form.add_field('ignorewarnings', 'true')
+            if filekey:
+                form.add_field('filekey', filekey)
+            form.add_file('chunk', file.os_filename,
+                          FileChunk(f, offset, min(chunk_size, size - offset)))
+            return self.post_form(form)
+
+        def publish(edit_token):
+            form = MultiPartForm()
+            form.add_field('action', 'upload')
+            form.add_field('filename', wiki_filename)
+            form.add_field('filekey', filekey)
+            form.add_field('comment', file.wikitext)
+            form.add_field('text', file.wikitext)
+            form.add_field('token', edit_token)
+            form.add_field('ignorewarnings', 'true')
+            return self.post_form(form)
+
+        with open(file.filename, 'rb') as f:
+            while offset < size:
+                try:
+                    reply = self.with_token('edit', post_chunk)
+                except ApiError as e:
+                    # anything else (a timeout, a server error) leaves the
+                    # saved offset to resume from next time
+                    if not done or e.code not in self.stash_errors:
+                        raise
+                    # the stash no longer has the chunks uploaded before
+                    print("starting again... ", end='', file=sys.stderr)
+                    filekey, offset, done = None, 0, None
+                    continue
+                done = None
+                filekey = reply.get('filekey') or reply.get('sessionkey')
+                if reply['result'] == 'Continue':
+                    offset = int(reply['offset'])
+                else:
+                    offset = size
+                self.save_chunks(file.filename,
+                                 {'filekey': filekey, 'offset': offset,
+                                  'size': size, 'mtime': stat.st_mtime})
+
+        self.with_token('edit', publish)
+        self.save_chunks(file.filename, None)
+
+
+    def save_chunks(self, filename, progress):
+        with self.__chunks_lock:
+            if progress is None:
+                self.chunks.pop(filename, None)
+            else:
+                self.chunks[filename] = progress
+            if self.chunks_filename:
+                with open(self.chunks_filename + '.tmp', 'w') as f:
+                    json.dump(self.chunks, f)
+                if os.path.exists(self.chunks_filename):
+                    os.remove(self.chunks_filename)
+                os.rename(self.chunks_filename + '.tmp', self.chunks_filename)
+
+
     def get_duplicate_name(self, file):
-        sha1 = hashlib.sha1()
-        f = open(file.filename, 'rb')
-        while True:
-            block = f.read(512)
-            if not block:
-                break
-            sha1.update(block)
         reply = self.api_request(action='query',
                                  list='allimages',
-                                 aisha1=sha1.hexdigest())
+                                 aisha1=file.sha1)
         if len(reply['allimages']):
             duplicate_name = reply['allimages'][0]['title']
             return duplicate_name
@@ -824,21 +3087,15 @@ class UploadBot(object):
               file=sys.stderr)
         sys.stderr.flush()
         
-        reply = self.api_request(action='query',
-                                 prop='info',
-                                 titles=old_wiki_filename,
-                                 intoken='move')
-        move_token = reply['pages'].values()[0]['movetoken']
-
-        reply = self.api_request(action='move',
-                                 from_='File:' + old_wiki_filename,
-                                 to='File:' + new_wiki_filename,
-                                 reason="Moving to proper filename "
-                                        "per NARA metadata",
-                                 movetalk=True,
-                                 movesubpages=True,
-                                 ignorewarnings=True,
-                                 token=move_token)
+        reply = self.with_token('move', lambda move_token: self.api_request(
+            action='move',
+            from_='File:' + old_wiki_filename,
+            to='File:' + new_wiki_filename,
+            reason="Moving to proper filename per NARA metadata",
+            movetalk=True,
+            movesubpages=True,
+            ignorewarnings=True,
+            token=move_token))
         # TODO change text of new page
         # errors should throw an exception right now...
         if True:
@@ -856,6 +3113,15 @@ class UploadBot(object):
               file=sys.stderr)
         open(new_filename + '.txt', 'w').write(file.wikitext)
 
+
+    def report(self):
+        print("API tokens: {0} fetched ({1}), {2} rejected".format(
+            sum(self.token_stats.values()),
+            ', '.join("{0} {1}".format(n, kind)
+                      for kind, n in sorted(self.token_stats.items())),
+            self.tokens_rejected))
+        self.rate.report()
+
 #
 # End of the UPLOAD BOT class definition
 ###############################################################################
@@ -863,13 +3129,45 @@ class UploadBot(object):
 # c/o http://www.doughellmann.com/PyMOTW/urllib2/
 #
 
+class FileChunk(object):
+    """A part of an open file, read like a file of its own."""
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        # the file may have been read elsewhere since
+        self.f.seek(self.offset + self.position)
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
 class MultiPartForm(object):
-    """Accumulate the data to be used when posting a form."""
+    """Accumulate the data to be used when posting a form.
+
+    The form is read like a file, one part after another, so that the files
+    attached are streamed from disk rather than held in memory; its length
+    is worked out from the sizes of the parts.
+    """
 
     def __init__(self):
         self.form_fields = []
         self.files = []
         self.boundary = mimetools.choose_boundary()
+        self.__parts = None
         return
     
     def get_content_type(self):
@@ -878,58 +3176,94 @@ class MultiPartForm(object):
     def add_field(self, name, value):
         """Add a simple field to the form data."""
         self.form_fields.append((name, value))
+        self.__parts = None
         return
 
     def add_file(self, fieldname, filename, fileHandle, mimetype=None):
-        """Add a file to be uploaded."""
-        body = fileHandle.read()
+        """Add a file to be uploaded, to be read as the form is sent."""
         if mimetype is None:
             mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        self.files.append((fieldname, filename, mimetype, body))
+        self.files.append((fieldname, filename, mimetype, fileHandle))
+        self.__parts = None
         return
-    
-    def __str__(self):
-        """Return a string representing the form data, including attached files."""
-        # Build a list of lists, each containing "lines" of the
-        # request.  Each part is separated by a boundary string.
-        # Once the list is built, return a string where each
-        # line is separated by '\r\n'.  
+
+    def parts(self):
+        """Return the parts of the form, strings and open files in turn."""
+        # Each part is separated by a boundary string, and every line is
+        # ended with '\r\n'.
+        def encode(s):
+            if type(s) is unicode:
+                return s.encode('utf-8')
+            else:
+                return s
         parts = []
         part_boundary = '--' + self.boundary
         
         # Add the form fields
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: form-data; charset=utf-8; name="%s"' % name,
-              '',
-              value,
-            ]
-            for name, value in self.form_fields
-            )
+        for name, value in self.form_fields:
+            parts.append('\r\n'.join([
+                part_boundary,
+                'Content-Disposition: form-data; charset=utf-8; name="%s"' % name,
+                '',
+                encode(value),
+                '']))
         
         # Add the files to upload
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: file; name="%s"; filename="%s"' % \
-                 (field_name, filename),
-              'Content-Type: %s' % content_type,
-              '',
-              body,
-            ]
-            for field_name, filename, content_type, body in self.files
-            )
+        for field_name, filename, content_type, fileHandle in self.files:
+            parts.append('\r\n'.join([
+                part_boundary,
+                encode('Content-Disposition: file; name="%s"; filename="%s"' % \
+                       (field_name, filename)),
+                'Content-Type: %s' % content_type,
+                '',
+                '']))
+            parts.append(fileHandle)
+            parts.append('\r\n')
         
-        # Flatten the list and add closing boundary marker,
-        # then return CR+LF separated data
-        flattened = list(itertools.chain(*parts))
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        def encode(s):
-            if type(s) is unicode:
-                return s.encode('utf-8')
+        # Add the closing boundary marker
+        parts.append('--' + self.boundary + '--\r\n')
+        return parts
+
+    def __len__(self):
+        return sum(len(part) if hasattr(part, '__len__')
+                   else os.fstat(part.fileno()).st_size
+                   for part in self.parts())
+
+    def seek(self, offset):
+        """Go back to the start of the form (the only offset supported)."""
+        if offset != 0:
+            raise IOError("a form can only be read again from the start")
+        self.__parts = None
+
+    def read(self, size=-1):
+        """Read up to size bytes of the form data (all of it by default)."""
+        if self.__parts is None:
+            self.__parts = collections.deque(self.parts())
+            for part in self.__parts:
+                if hasattr(part, 'read'):
+                    part.seek(0)
+        out = []
+        while self.__parts and size != 0:
+            part = self.__parts[0]
+            if hasattr(part, 'read'):
+                data = part.read(size)
+                if not data or size < 0:
+                    self.__parts.popleft()
             else:
-                return s
-        return '\r\n'.join([encode(s) for s in flattened])
+                data = part if size < 0 else part[:size]
+                if len(data) == len(part):
+                    self.__parts.popleft()
+                else:
+                    self.__parts[0] = part[len(data):]
+            out.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(out)
+
+    def __str__(self):
+        """Return a string representing the form data, including attached files."""
+        self.seek(0)
+        return self.read()
 
 #    
 # end of MULTI-PART FORM class
@@ -937,6 +3271,18 @@ class MultiPartForm(object):
 # The main section, runs if this module is run as the main program
 #
 
+def print_report():
+    # statistics of the metadata sources used in this run
+    print()
+    Item.transport.report()
+    if Item.page_cache:
+        Item.page_cache.report()
+    Item.place_resolver.report()
+    Item.hierarchy_cache.report()
+    parse_timer.report()
+    if Item.metadata_backend:
+        Item.metadata_backend.report()
+
 if __name__ == '__main__':
     
     print("\n\n\n")
@@ -950,7 +3296,7 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(
         description="MediaWiki file uploader for NARA")
-    parser.add_argument('directories', metavar='DIR', type=str, nargs='+',
+    parser.add_argument('directories', metavar='DIR', type=str, nargs='*',
                         help="directory with images to upload")
     parser.add_argument('--username', dest='username', metavar='USERNAME',
                         action='store',
@@ -968,13 +3314,115 @@ if __name__ == '__main__':
     parser.add_argument('--overflow', dest='overflow_dir',
                         metavar='OVERFLOW_DIR', action='store', default=None,
                         help="directory to store overly-large files in"
-                             " (required with --max-size)")
+                             " (required with --max-size, unless"
+                             " --chunk-size is given)")
+    parser.add_argument('--chunk-size', dest='chunk_size', metavar='SIZE',
+                        action='store', default=None, type=int,
+                        help="upload files larger than SIZE bytes to the "
+                             "stash in chunks of SIZE bytes (or --max-size, "
+                             "if smaller), resumably with --state-file, "
+                             "including those over --max-size (optional)")
     parser.add_argument('--unknowns-file', dest='unknowns_file',
                         metavar='STATE_FILE', action='store', default=None,
                         help="file to record unknown files (optional)")
     parser.add_argument('--state-file', dest='state_file',
                         metavar='STATE_FILE', action='store', default=None,
                         help="file to record upload batch state (optional)")
+    parser.add_argument('--incremental', dest='incremental',
+                        action='store_true', default=False,
+                        help="only upload files which are new or modified "
+                             "since the last run (requires --state-file)")
+    parser.add_argument('--plan', dest='plan_file', metavar='PLAN_FILE',
+                        action='store', default=None,
+                        help="write an upload plan for DIR to PLAN_FILE "
+                             "instead of uploading (no login needed)")
+    parser.add_argument('--execute-plan', dest='execute_plan_file',
+                        metavar='PLAN_FILE', action='store', default=None,
+                        help="upload the files in a plan written by --plan")
+    parser.add_argument('--prefetch', dest='prefetch', metavar='N',
+                        action='store', default=0, type=int,
+                        help="scrape metadata for the next N items while "
+                             "uploading (default: 0)")
+    parser.add_argument('--upload-workers', dest='upload_workers',
+                        metavar='N', action='store', default=1, type=int,
+                        help="upload N files at a time (default: 1)")
+    parser.add_argument('--max-in-flight', dest='max_in_flight',
+                        metavar='SIZE', action='store', default=None,
+                        type=int,
+                        help="with --upload-workers, upload at most SIZE "
+                             "bytes of files at a time (optional)")
+    parser.add_argument('--maxlag', dest='maxlag', metavar='SECONDS',
+                        action='store', default=5, type=int,
+                        help="have the API turn requests away while its "
+                             "servers are lagged by more than SECONDS, and "
+                             "slow down when it does (default: 5)")
+    parser.add_argument('--per-host', dest='per_host', metavar='N',
+                        action='store', default=2, type=int,
+                        help="maximum concurrent requests to each catalog "
+                             "host while prefetching (default: 2)")
+    parser.add_argument('--template', dest='template_file',
+                        metavar='TEMPLATE_FILE', action='store', default=None,
+                        help="describe the files with the wikitext template "
+                             "in TEMPLATE_FILE (UTF-8, in str.format syntax "
+                             "with the fields " +
+                             ", ".join(WikitextTemplate.fields) +
+                             ") instead of NARA-image-full")
+    parser.add_argument('--page-index', dest='page_index_title',
+                        metavar='TITLE', nargs='?', const=PAGE_INDEX_TITLE,
+                        default=None,
+                        help="list the pages of each multi-page item once, "
+                             "on the page TITLE (formatted with {arcid}; "
+                             "default: " + PAGE_INDEX_TITLE + "), instead "
+                             "of in every page's description")
+    parser.add_argument('--parse-workers', dest='parse_workers',
+                        metavar='N', action='store', default=0, type=int,
+                        help="parse catalog pages in N worker processes "
+                             "(most useful with --prefetch)")
+    parser.add_argument('--opa-api', dest='opa_api_url', metavar='API_URL',
+                        action='store', nargs='?', const=OPA_API_URL,
+                        default=None,
+                        help="take metadata from the OPA API instead of "
+                             "scraping arcweb (default API_URL: {0})"
+                             .format(OPA_API_URL))
+    parser.add_argument('--opa-record', dest='opa_record_dir',
+                        metavar='RECORD_DIR', action='store', default=None,
+                        help="save the OPA API descriptions received to "
+                             "RECORD_DIR, for opa-standin.py (optional)")
+    parser.add_argument('--harvest', dest='harvest_file',
+                        metavar='HARVEST_FILE', action='store', default=None,
+                        help="resolve the metadata of every arcid in the "
+                             "index into HARVEST_FILE instead of uploading "
+                             "(no login or DIR needed)")
+    parser.add_argument('--metadata', dest='metadata_file',
+                        metavar='HARVEST_FILE', action='store', default=None,
+                        help="take metadata from a file written by "
+                             "--harvest instead of scraping it")
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        metavar='CACHE_DIR', action='store', default=None,
+                        help="directory to cache catalog pages in (optional)")
+    parser.add_argument('--cache-ttl', dest='cache_ttl', metavar='SECONDS',
+                        action='store', default=None, type=int,
+                        help="refetch cached pages older than this "
+                             "(default: never)")
+    parser.add_argument('--cache-max-size', dest='cache_max_size',
+                        metavar='SIZE', action='store', default=None,
+                        type=int,
+                        help="maximum size of the page cache in bytes, "
+                             "evicting the least recently used pages "
+                             "(optional)")
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        default=False,
+                        help="only use cached catalog pages (requires "
+                             "--cache-dir)")
+    parser.add_argument('--places-file', dest='places_file',
+                        metavar='PLACES_FILE', action='store', default=None,
+                        help="file to keep place coordinates in between "
+                             "runs (optional)")
+    parser.add_argument('--order-by-folder', dest='order',
+                        action='store_const', const='folder',
+                        default='arcid',
+                        help="process items folder by folder rather than in "
+                             "arcid order, keeping series together")
     parser.add_argument('--api', dest='api_url',
                         metavar='API_URL', action='store',
                         default='https://commons.wikimedia.org/w/api.php',
@@ -982,6 +3430,50 @@ if __name__ == '__main__':
                              "(default: Wikimedia Commons' API)")
     args = parser.parse_args()
 
+    if not args.directories and not (args.execute_plan_file or
+                                     args.harvest_file):
+        parser.error("at least one DIR is required")
+
+    if args.offline and not args.cache_dir:
+        parser.error("--offline requires --cache-dir")
+
+    if args.prefetch:
+        Item.host_limiter = HostLimiter(args.per_host)
+    if args.parse_workers:
+        Item.parser_pool = ParserPool(args.parse_workers)
+    if args.page_index_title:
+        Item.page_index_title = args.page_index_title
+    if args.template_file:
+        try:
+            File.wikitext_template = \
+                WikitextTemplate.from_file(args.template_file)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    if args.places_file:
+        Item.place_resolver = PlaceResolver(args.places_file)
+    if args.opa_api_url:
+        Item.metadata_backend = OpaApiBackend(args.opa_api_url,
+                                              record_dir=args.opa_record_dir)
+    if args.metadata_file:
+        Item.metadata_backend = HarvestBackend(args.metadata_file)
+    if args.cache_dir:
+        Item.page_cache = PageCache(args.cache_dir,
+                                    ttl=args.cache_ttl,
+                                    max_size=args.cache_max_size,
+                                    offline=args.offline)
+
+    if args.harvest_file:
+        harvest(args.index_file, args.harvest_file, prefetch=args.prefetch)
+        print_report()
+        sys.exit(0)
+
+    if args.plan_file:
+        write_plan(Batch(args.index_file, *args.directories,
+                         order=args.order),
+                   args.plan_file, prefetch=args.prefetch)
+        print_report()
+        sys.exit(0)
+
     if not args.username or not args.password:
         print("error: username and password required",
               file=sys.stderr)
@@ -994,6 +3486,18 @@ if __name__ == '__main__':
                     max_size=args.max_size,
                     overflow_dir=args.overflow_dir,
                     state_filename=args.state_file,
-                    unknowns_filename=args.unknowns_file)
-    bot.upload_directory(*args.directories)
+                    unknowns_filename=args.unknowns_file,
+                    prefetch=args.prefetch,
+                    chunk_size=args.chunk_size,
+                    upload_workers=args.upload_workers,
+                    max_in_flight=args.max_in_flight,
+                    maxlag=args.maxlag)
+    if args.execute_plan_file:
+        bot.execute_plan(args.execute_plan_file)
+    else:
+        bot.upload_directory(*args.directories,
+                             incremental=args.incremental,
+                             order=args.order)
+    print_report()
+    bot.report()
     sys.exit(0)
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+###############################################################################
+#                                                                             #
+#       OPA-STANDIN.PY (a local stand-in for the OPA public API)              #
+#                                                                             #
+#  Serves descriptions recorded with "narabot.py --opa-record RECORD_DIR"     #
+#  (one <naId>.json per result) in the shape of the API's search results,     #
+#  for any combination of naIds, so that the OPA API backend can be run and   #
+#  timed without the real API:                                               #
+#                                                                             #
+#      python opa-standin.py RECORD_DIR [PORT]                                #
+#      python narabot.py --opa-api http://localhost:PORT/api/v1 ...           #
+#                                                                             #
+###############################################################################
+
+from __future__ import print_function
+import BaseHTTPServer
+import json
+import os
+import sys
+import urlparse
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    record_dir = '.'
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        result_types = params.get('resultTypes')
+        results = []
+        for naId in params.get('naIds', '').split(','):
+            filename = os.path.join(self.record_dir, naId.strip() + '.json')
+            if naId.strip() and os.path.exists(filename):
+                result = json.load(open(filename))
+                if not result_types or result.get('@resultType') in \
+                        result_types.split(','):
+                    results.append(result)
+        body = json.dumps({'opaResponse': {
+            'header': {'@status': '200',
+                       'request': dict(params, **{'@path': url.path})},
+            'results': {'@total': str(len(results)),
+                        '@offset': '0',
+                        '@rows': str(len(results)),
+                        'result': results}}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(record_dir, port=8080):
+    StandinHandler.record_dir = record_dir
+    server = BaseHTTPServer.HTTPServer(('localhost', port), StandinHandler)
+    print("Serving \"{0}\" at http://localhost:{1}/api/v1".format(
+        record_dir, server.server_port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: opa-standin.py RECORD_DIR [PORT]", file=sys.stderr)
+        sys.exit(1)
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8080)